@@ -217,8 +217,12 @@ def make_contours_for_pack(pack_id, clean=False, procs=2):
         procs=procs)
 
 
-def make_water_for_pack(pack_id, clean=False, procs=2):
-    """Make water mbtiles given a pack"""
+def make_water_for_pack(pack_id, clean=False, procs=2, trim=False):
+    """Make water mbtiles given a pack
+
+    With trim, waterways far from the pack only get exported as generalized
+    main stems.
+    """
     pack_dir = get_pack_dir(pack_id)
     water_mbtiles_path = os.path.join(pack_dir, "water.mbtiles")
     if os.path.isfile(water_mbtiles_path) and not clean:
@@ -231,7 +235,8 @@ def make_water_for_pack(pack_id, clean=False, procs=2):
         geojson_path=pack["geojson_path"],
         clean=clean,
         path=water_mbtiles_path,
-        procs=procs)
+        procs=procs,
+        trim=trim)
 
 
 def make_ways_for_pack(pack_id, clean=False):
@@ -265,11 +270,11 @@ def make_context_for_pack(pack_id, clean=False):
 
 def make_pack(pack_id, clean=False, clean_rocks=False, clean_water=False,
               clean_ways=False, clean_context=False, clean_contours=False,
-              procs=2):
+              procs=2, trim_water=False):
     """Generate a pack and write it to the build directory"""
     pack_dir = get_pack_dir(pack_id)
     make_rocks_for_pack(pack_id, clean=(clean or clean_rocks), procs=procs)
-    make_water_for_pack(pack_id, clean=(clean or clean_water), procs=procs)
+    make_water_for_pack(pack_id, clean=(clean or clean_water), procs=procs, trim=trim_water)
     make_ways_for_pack(pack_id, clean=(clean or clean_ways))
     make_context_for_pack(pack_id, clean=(clean or clean_context))
     make_contours_for_pack(pack_id, clean=(clean or clean_contours), procs=procs)
@@ -295,7 +300,8 @@ def make_all_packs_from_args(args):
                 clean_ways=args.clean_ways,
                 clean_context=args.clean_context,
                 clean_contours=args.clean_contours,
-                procs=args.procs)
+                procs=args.procs,
+                trim_water=args.trim_water)
             util.log(f"Pack available at {pack_path}")
         except: # pylint: disable=bare-except
             fails.append(pack_id)
@@ -320,7 +326,8 @@ def make_single_pack_from_args(args):
         clean_ways=args.clean_ways,
         clean_context=args.clean_context,
         clean_contours=args.clean_contours,
-        procs=args.procs)
+        procs=args.procs,
+        trim_water=args.trim_water)
     make_manifest(manifest_url=args.manifest_url, s3_bucket_url=args.s3_bucket_url)
     util.log(f"Pack available at {pack_path}")
 
@@ -357,6 +364,10 @@ if __name__ == "__main__":
         "--clean-contours",
         action="store_true",
         help="Clean all cached files for contours before building")
+    parser.add_argument(
+        "--trim-water",
+        action="store_true",
+        help="Only export generalized main stems of waterways far from the pack")
     parser.add_argument(
         "--procs",
         type=int,
@@ -392,7 +403,11 @@ if __name__ == "__main__":
         if "rocks" in args.only:
             make_rocks_for_pack(args.pack, clean=args.clean, procs=args.procs)
         if "water" in args.only:
-            make_water_for_pack(args.pack, clean=args.clean, procs=args.procs)
+            make_water_for_pack(
+                args.pack,
+                clean=args.clean,
+                procs=args.procs,
+                trim=args.trim_water)
         if "contours" in args.only:
             make_contours_for_pack(args.pack, clean=args.clean, procs=args.procs)
         if "ways" in args.only:
@@ -4,10 +4,10 @@ Geologic map of California : Santa Maria Sheet
 
 import os
 import re
-from difflib import SequenceMatcher
 
 from util.rocks import process_usgs_source
 from util.proj import NAD83_CA_ALBERS
+from util.text import remove_similar_pieces
 
 PARENTHETICAL_REFERENCE_PATTERN = r'\(([^\(]+? \d{4},?)+?\)'
 
@@ -27,21 +27,8 @@ def description_from_row(row):
     # why doesn't python have ordered uniq, whyyyyyy
     unique_pieces = list(dict.fromkeys([piece.strip() for piece in flattened_pieces]))
     pieces = [piece for piece in unique_pieces if len(piece) > 0]
-    # Reverse so our similarity check removes similar things from the end
-    pieces.reverse()
-    new_pieces = []
-    for idx, piece in enumerate(pieces):
-        similar_piece = next(
-            (
-                candidate for candidate in pieces[idx+1:]
-                if SequenceMatcher(None, piece, candidate).ratio() > 0.80
-            ),
-            None
-        )
-        if not similar_piece:
-            new_pieces.append(piece)
-    new_pieces.reverse()
-    return ". ".join(new_pieces).strip()
+    # Remove similar things from the end
+    return ". ".join(remove_similar_pieces(pieces)).strip()
 
 
 def run():
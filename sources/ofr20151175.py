@@ -18,15 +18,23 @@ SRS = "+proj=utm +zone=11 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs"
 
 
 def get_archive(url):
-    """Download and extract the archive"""
+    """Download the archive and return a path to the GeoDatabase
+
+    The GeoDatabase is read in place from the zip if GDAL can manage it,
+    otherwise the archive gets extracted.
+    """
     download_path = os.path.basename(url)
     if not os.path.isfile(download_path):
         print(f"DOWNLOADING {url}")
         util.call_cmd(["curl", "-OL", url])
     gdb_path = "JOTR_OFR_v10-2.gdb"
-    if not os.path.isdir(gdb_path):
-        print("EXTRACTING ARCHIVE...")
-        util.unzip(download_path)
+    if os.path.isdir(gdb_path):
+        return os.path.realpath(gdb_path)
+    in_place_gdb_path = util.vsi_path(download_path, gdb_path, archive_type="zip")
+    if util.gdal_can_read(in_place_gdb_path):
+        return in_place_gdb_path
+    print("EXTRACTING ARCHIVE...")
+    util.unzip(download_path)
     return os.path.realpath(gdb_path)
 
 
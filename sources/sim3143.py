@@ -6,10 +6,10 @@ import os
 import re
 import time
 from datetime import date
-import fiona
 
 import util
 from util import rocks
+from util.attributes import distinct_attributes
 
 work_path = util.make_work_dir(os.path.realpath(__file__))
 os.chdir(work_path)
@@ -74,48 +74,47 @@ def schemify_attributes(attributes_path):
     units_from_shp = {}
     shp_path = os.path.join(os.path.dirname(attributes_path), "GM_MapUnitPolys.shp")
     unit_overrides = get_unit_overrides()
-    with fiona.open(shp_path) as units:
-        for unit in units:
-            if "properties" not in unit:
-                continue
-            code = unit["properties"]["MapUnit"]
-            if code in units_from_shp:
-                continue
-            min_age = None
-            max_age = None
-            est_age = None
-            if age_range := unit["properties"].get("AgeRange", None):
-                if match := re.match(r"([\d\.\,]+)\s*?(to|-)\s*?([\d\.\,]+)\s*(.+)", age_range):
-                    age1_s, _btwn, age2_s, age_unit = match.groups()
-                    age1 = locale.atof(age1_s)
-                    age2 = locale.atof(age2_s)
-                    year_multiplier = 1
-                    if "Ma" in age_unit:
-                        year_multiplier = 1_000_000
-                    min_age, max_age = sorted([age * year_multiplier for age in [age1, age2]])
-                    est_age = (min_age + max_age) / 2
-                elif match := re.match(r"A\.D\.\s*(\d{4})\s*?-?\s*?(\d{4})?", age_range):
-                    year1, year2 = match.groups()
-                    years = [int(year1)]
-                    if year2:
-                        years.append(int(year2))
-                    else:
-                        years.append(int(year1))
-                    current_year = date.today().year
-                    min_age, max_age = sorted([current_year - year for year in years])
-                    est_age = (min_age + max_age) / 2
-            units_from_shp[code] = {
-                "code": code,
-                "lithology": rocks.lithology_from_text(unit["properties"]["Com"]),
-                "min_age": min_age,
-                "max_age": max_age,
-                "est_age": est_age,
-                "span": rocks.span_from_usgs_code(code),
-                "controlled_span": rocks.controlled_span_from_span(rocks.span_from_usgs_code(code)),
-                "formation": unit["properties"]["Formation"],
-                "title": f"{unit['properties']['Formation']}: {unit['properties']['RockType']}",
-                "description": f"{unit['properties']['Com']}. {unit['properties']['Lithology']}"
-            }
+    shp_units = distinct_attributes(
+        shp_path,
+        "MapUnit",
+        columns=["AgeRange", "Com", "Formation", "RockType", "Lithology"]
+    )
+    for code, properties in shp_units.items():
+        min_age = None
+        max_age = None
+        est_age = None
+        if age_range := properties.get("AgeRange", None):
+            if match := re.match(r"([\d\.\,]+)\s*?(to|-)\s*?([\d\.\,]+)\s*(.+)", age_range):
+                age1_s, _btwn, age2_s, age_unit = match.groups()
+                age1 = locale.atof(age1_s)
+                age2 = locale.atof(age2_s)
+                year_multiplier = 1
+                if "Ma" in age_unit:
+                    year_multiplier = 1_000_000
+                min_age, max_age = sorted([age * year_multiplier for age in [age1, age2]])
+                est_age = (min_age + max_age) / 2
+            elif match := re.match(r"A\.D\.\s*(\d{4})\s*?-?\s*?(\d{4})?", age_range):
+                year1, year2 = match.groups()
+                years = [int(year1)]
+                if year2:
+                    years.append(int(year2))
+                else:
+                    years.append(int(year1))
+                current_year = date.today().year
+                min_age, max_age = sorted([current_year - year for year in years])
+                est_age = (min_age + max_age) / 2
+        units_from_shp[code] = {
+            "code": code,
+            "lithology": rocks.lithology_from_text(properties["Com"]),
+            "min_age": min_age,
+            "max_age": max_age,
+            "est_age": est_age,
+            "span": rocks.span_from_usgs_code(code),
+            "controlled_span": rocks.controlled_span_from_span(rocks.span_from_usgs_code(code)),
+            "formation": properties["Formation"],
+            "title": f"{properties['Formation']}: {properties['RockType']}",
+            "description": f"{properties['Com']}. {properties['Lithology']}"
+        }
     outfile_path = "units.csv"
     with open(outfile_path, 'w', encoding="utf-8") as outfile:
         columns = rocks.METADATA_COLUMN_NAMES
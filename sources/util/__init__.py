@@ -4,6 +4,7 @@
 """
 
 from subprocess import call, run
+import io
 import json
 import os
 import re
@@ -13,10 +14,15 @@ from glob import glob
 import xml.etree.ElementTree as ET
 import csv
 from datetime import datetime as dt
+from xml.sax.saxutils import escape, quoteattr
 import psycopg2
 
+from .met import parse_met
 from .proj import *
 
+# Number of processes to use when a source can do work in parallel
+NUM_PROCESSES = 4
+
 
 def log(msg="", **kwargs):
     """Logging utility"""
@@ -66,6 +72,40 @@ def run_sql(sql, dbname="underfoot", quiet=False, interpolations=None):
     return results
 
 
+def copy_rows_to_table(table_name, columns, rows, dbname="underfoot"):
+    """Bulk load an iterable of row tuples into an existing table with COPY"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+    buffer.seek(0)
+    con = psycopg2.connect(f"dbname={dbname}")
+    cur = con.cursor()
+    log(f"Copying rows into {table_name} ({', '.join(columns)})")
+    cur.copy_expert(
+        f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH CSV",
+        buffer
+    )
+    con.commit()
+    cur.close()
+    con.close()
+
+
+def copy_csv_to_table(table_name, csv_path, dbname="underfoot"):
+    """Bulk load a CSV with a header row into an existing table with COPY"""
+    con = psycopg2.connect(f"dbname={dbname}")
+    cur = con.cursor()
+    log(f"Copying {csv_path} into {table_name}")
+    with open(csv_path, encoding="utf-8") as csv_file:
+        cur.copy_expert(
+            f"COPY {table_name} FROM STDIN WITH CSV HEADER",
+            csv_file
+        )
+    con.commit()
+    cur.close()
+    con.close()
+
+
 def run_sql_with_retries(
     sql,
     max_retries=3,
@@ -129,7 +169,8 @@ def polygonize_arcs(
     shapefiles_path,
     polygon_pattern=".+-ID?$",
     force=False,
-    outfile_path=None
+    outfile_path=None,
+    procs=1
 ):
     """Convert shapefile arcs from an extracted ArcINFO coverage and convert
     them to polygons.
@@ -165,22 +206,66 @@ def polygonize_arcs(
         pal_path,
         arc_path,
         "--polygon-column-pattern",
-        polygon_pattern
+        polygon_pattern,
+        "--procs",
+        str(procs)
     ])
     return outfile_path
 
 
+def merge_layers(paths, output_path, src_layer=None, extra_args=None):
+    """Merge multiple vector files into a single file with one ogr2ogr call
+
+    Instead of a chain of `ogr2ogr -append` calls that each reopen the output,
+    this writes a VRT union layer of all the inputs and converts that, so
+    fields from all inputs are preserved and the output is written once.
+
+    Args:
+      paths: paths to the files to merge
+      output_path: path to the merged file
+      src_layer (optional): name of the layer to read from each input.
+        Defaults to the extensionless basename of each path, which is the
+        layer name for shapefiles
+      extra_args (optional): additional arguments for ogr2ogr, e.g. -nln
+    """
+    extra_args = extra_args or []
+    if len(paths) == 1:
+        call_cmd(["ogr2ogr", "-overwrite", output_path, paths[0]] + extra_args)
+        return output_path
+    vrt_path = f"{os.path.splitext(output_path)[0]}-merge.vrt"
+    union_layer_name = extless_basename(output_path)
+    layers = "\n".join([
+        f"""
+        <OGRVRTLayer name={quoteattr(f"src{idx}")}>
+          <SrcDataSource>{escape(os.path.realpath(path))}</SrcDataSource>
+          <SrcLayer>{escape(src_layer or extless_basename(path))}</SrcLayer>
+        </OGRVRTLayer>
+        """
+        for idx, path in enumerate(paths)
+    ])
+    with open(vrt_path, "w", encoding="utf-8") as vrt_file:
+        vrt_file.write(f"""
+          <OGRVRTDataSource>
+            <OGRVRTUnionLayer name={quoteattr(union_layer_name)}>
+              {layers}
+            </OGRVRTUnionLayer>
+          </OGRVRTDataSource>
+        """.strip())
+    call_cmd(
+        ["ogr2ogr", "-overwrite", output_path, vrt_path, union_layer_name]
+        + extra_args
+    )
+    os.remove(vrt_path)
+    return output_path
+
+
 def met2xml(path):
     """Converts a USGS metadata text file to XML"""
     output_path = os.path.join(
         os.path.realpath(os.path.dirname(path)),
         f"{extless_basename(path)}.xml"
     )
-    met2xml_path = os.path.join(
-        os.path.dirname(os.path.realpath(__file__)),
-        "met2xml.py"
-    )
-    call_cmd(["python", met2xml_path, path, output_path])
+    parse_met(path).write(output_path, encoding="utf-8")
     return output_path
 
 
@@ -259,6 +344,65 @@ def update_masks_table(mask_table_name, source_table_name, buff=0.01):
     """)
 
 
+def subdivide_masks_table(mask_table_name, parts_table_name, buff=None, max_vertices=256):
+    """
+      Splits a mask into small, spatially indexed pieces in a new table so
+      queries against it only have to look at the pieces near a geometry.
+      If buff is set each piece gets buffered by that much, which is the same
+      as buffering the whole mask but a lot cheaper.
+    """
+    run_sql(f"DROP TABLE IF EXISTS {parts_table_name}")
+    part_geom = f"ST_Buffer(geom, {buff})" if buff else "geom"
+    run_sql(f"""
+        CREATE TABLE {parts_table_name} AS
+        SELECT {part_geom} AS geom
+        FROM (
+            SELECT ST_Subdivide(ST_MakeValid(geom), {max_vertices}) AS geom
+            FROM {mask_table_name}
+        ) parts
+    """)
+    run_sql(f"""
+        CREATE INDEX {parts_table_name}_geom_idx ON {parts_table_name} USING GIST(geom)
+    """)
+    run_sql(f"ANALYZE {parts_table_name}")
+
+
+def append_masks_parts(parts_table_name, source_table_name, mask_buff=0.01, buff=None,
+                       max_vertices=256):
+    """
+      Adds pieces of the geometries update_masks_table would add to a mask to
+      a parts table made by subdivide_masks_table. The parts only have to
+      cover the same area as the mask, so this keeps them up to date without
+      subdividing the whole mask again.
+    """
+    part_geom = f"ST_Buffer(geom, {buff})" if buff else "geom"
+    run_sql(f"""
+        INSERT INTO {parts_table_name} (geom)
+        SELECT {part_geom}
+        FROM (
+            SELECT
+                ST_Subdivide(
+                    ST_MakeValid(
+                        ST_Buffer(
+                            ST_MakeValid(
+                                ST_Buffer(
+                                    ST_MakeValid(ST_Union(ST_MakeValid(geom))),
+                                    {mask_buff},
+                                    'join=mitre'
+                                )
+                            ),
+                            -{mask_buff},
+                            'join=mitre'
+                        )
+                    ),
+                    {max_vertices}
+                ) AS geom
+            FROM {source_table_name}
+        ) parts
+    """)
+    run_sql(f"ANALYZE {parts_table_name}")
+
+
 def add_table_from_query_to_mbtiles(
         table_name, dbname, query, mbtiles_path, index_columns=None):
     """Add a table to an MBTiles from a query to the Postgres db"""
@@ -289,3 +433,63 @@ def add_table_from_query_to_mbtiles(
 def unzip(path):
     """Unzip a zip file at a path, updating if necessary"""
     return call_cmd(["unzip", "-u", path])
+
+
+def archive_type_for_path(archive_path):
+    """Guess the type of an archive (zip, tar, or gzip) from its extension"""
+    if archive_path.endswith(".zip"):
+        return "zip"
+    if re.search(r"\.(tar|tar\.gz|tgz)$", archive_path):
+        return "tar"
+    if archive_path.endswith(".gz"):
+        return "gzip"
+    return None
+
+
+def vsi_path(archive_path, member_path=None, archive_type=None):
+    """GDAL virtual file system path for reading a file inside an archive
+
+    Lets GDAL / OGR read data straight out of an archive without extracting
+    it. Returns None if GDAL can't read the archive, e.g. .tar.Z files.
+
+    Args:
+      archive_path: path to the archive
+      member_path (optional): path of the file within the archive
+      archive_type (optional): zip, tar, or gzip. Inferred from the extension
+        of archive_path if not specified, which is handy for URLs that don't
+        end in an extension
+    """
+    archive_type = archive_type or archive_type_for_path(archive_path)
+    prefixes = {"zip": "/vsizip/", "tar": "/vsitar/", "gzip": "/vsigzip/"}
+    if archive_type not in prefixes:
+        return None
+    path = f"{prefixes[archive_type]}{os.path.realpath(archive_path)}"
+    if member_path and archive_type != "gzip":
+        path = f"{path}/{member_path}"
+    return path
+
+
+def gdal_can_read(path):
+    """Check whether OGR can open a path, e.g. a /vsizip/ path"""
+    # pylint: disable=subprocess-run-check
+    return run(
+        ["ogrinfo", "-ro", "-so", "-q", path],
+        capture_output=True
+    ).returncode == 0
+
+
+def extract_archive_members(archive_path, patterns, archive_type="zip"):
+    """Extract only the files matching patterns from an archive
+
+    For when most of the archive can be read in place but some files, like
+    CSVs, need to be on disk. Patterns that don't match anything are ignored.
+    """
+    if archive_type == "zip":
+        cmd = ["unzip", "-u", "-o", archive_path]
+    else:
+        # tar figures out the compression on its own when extracting
+        cmd = ["tar", "xvf", archive_path, "--wildcards"]
+    # unzip and tar both exit with errors if a pattern doesn't match, so try
+    # them one at a time
+    for pattern in patterns:
+        call_cmd(cmd + [pattern], check=False)
@@ -0,0 +1,81 @@
+"""
+Methods for converting a collection of Arc INFO arcs to polygons. See
+polygonize_arcs.py for the script that uses them.
+"""
+import re
+from collections import defaultdict
+from multiprocessing import Pool
+
+from shapely.geometry import shape, mapping
+from shapely.ops import polygonize
+import fiona
+
+SCHEMA = {
+  'geometry': 'Polygon',
+  'properties': {
+    'POLY_ID': 'str',
+    'PTYPE': 'str'
+  }
+}
+
+
+def index_arcs(arcs):
+    """Map polygon IDs to the geometries of the arcs on either side of them"""
+    lines_by_polygon_id = defaultdict(list)
+    for arc in arcs:
+        lpoly = arc["properties"]["LPOLY_"]
+        rpoly = arc["properties"]["RPOLY_"]
+        line = shape(arc["geometry"])
+        lines_by_polygon_id[lpoly].append(line)
+        if rpoly != lpoly:
+            lines_by_polygon_id[rpoly].append(line)
+    return lines_by_polygon_id
+
+
+def polygon_records(polygon_id, ptype, lines):
+    """Polygonize the arcs for a single polygon into output records"""
+    return [
+        {
+            'properties': {
+              'POLY_ID': polygon_id,
+              'PTYPE': ptype
+            },
+            'geometry': mapping(polygon)
+        }
+        for polygon in polygonize(lines)
+    ]
+
+
+def polygonize_arcs(
+    output_path,
+    pal_path,
+    arc_path,
+    polygon_pattern=".+_SP-PY-I$",
+    procs=1,
+    debug=False
+):
+    """Write polygons for every polygon in PAL.shp using arcs in ARC.shp"""
+    with fiona.open(arc_path) as arc:
+        lines_by_polygon_id = index_arcs(arc)
+    jobs = []
+    with fiona.open(pal_path) as pal:
+        polygon_column = next(
+            x for x in pal.schema["properties"].keys()
+            if re.search(polygon_pattern, x)
+        )
+        if debug:
+            print("polygon_column: ", polygon_column)
+        for pf in pal:
+            polygon_id = pf["properties"][polygon_column]
+            ptype = pf["properties"]["PTYPE"]
+            lines = lines_by_polygon_id.get(polygon_id, [])
+            if debug:
+                print(f"polygon_id: {polygon_id}, ptype: {ptype}, lines: {len(lines)}")
+            jobs.append((polygon_id, ptype, lines))
+    if procs > 1:
+        with Pool(processes=procs) as pool:
+            results = pool.starmap(polygon_records, jobs, chunksize=64)
+    else:
+        results = [polygon_records(*job) for job in jobs]
+    with fiona.collection(output_path, "w", "ESRI Shapefile", SCHEMA) as output:
+        output.writerecords(record for records in results for record in records)
@@ -0,0 +1,48 @@
+"""Methods for reading feature attributes without their geometries"""
+
+import fiona
+
+
+def read_attributes(path, columns=None, layer=None):
+    """Yield the properties of every feature in a file OGR can read
+
+    Only the requested columns are read when the driver supports it, and
+    geometries are never decoded, so this is a lot faster than iterating over
+    features when all you need are attributes.
+    """
+    open_kwargs = {"layer": layer} if layer else {}
+    try:
+        features = fiona.open(
+            path,
+            include_fields=columns,
+            ignore_geometry=True,
+            **open_kwargs
+        )
+    except fiona.errors.DriverError:
+        # Not every driver can skip fields, e.g. GeoJSON
+        features = fiona.open(path, **open_kwargs)
+    with features:
+        for feature in features:
+            if not feature.get("properties"):
+                continue
+            properties = dict(feature["properties"])
+            if columns:
+                properties = {col: properties.get(col) for col in columns}
+            yield properties
+
+
+def distinct_attributes(path, key, columns=None, layer=None):
+    """Return a dict of the first set of properties for each value of key
+
+    Features with an empty key are skipped. If columns are specified, key
+    will get read along with them.
+    """
+    if columns and key not in columns:
+        columns = [key] + list(columns)
+    distinct = {}
+    for properties in read_attributes(path, columns=columns, layer=layer):
+        value = properties.get(key)
+        if not value or value in distinct:
+            continue
+        distinct[value] = properties
+    return distinct
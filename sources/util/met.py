@@ -0,0 +1,123 @@
+"""
+Parses the metadata in USGS metadata text files back into the XML from whence
+it came
+
+This is a very flawed parser that assumes a text file with key: value pairs
+where indentation determines depth. USGS metadata text files are pretty
+messy, often with inconsistent indentation. Sometimes they contain lines
+that will just screw this up, like text blocks that contain a leading
+`word:otherword` combo.
+"""
+
+import os
+import re
+from functools import lru_cache
+import xml.etree.ElementTree as ET
+
+DEBUG = False
+LINE_PATTERN = re.compile(r'^\s*(([a-zA-Z_\-]+):)?\s*?(.+)?')
+ROOT_TAG = "Metadata"
+
+
+def parse_met_lines(lines):
+    """Parse an iterable of lines from a met file into an ElementTree"""
+    root = ET.Element(ROOT_TAG)
+    stack = [{'node': root, 'indent': -1}]
+    prev_indent = 0
+    prev_node = root
+    for line in lines:
+        # skip blank line
+        if not line or len(line.strip()) == 0:
+            continue
+        indent = len(line) - len(line.lstrip())
+        if DEBUG:
+            print(
+                f"### {str(prev_indent).rjust(5)} {str(indent).rjust(5)} "
+                f"{line.rstrip()}"
+            )
+        matches = LINE_PATTERN.match(line)
+        # skip lines that don't match the key/value pattern
+        if not matches:
+            continue
+        _keycolon, key, val = matches.groups()
+        # if there's a key and the indentation went down, that means we're
+        # closing tags, so pop out based on the level of indentation
+        if key and indent < prev_indent:
+            while len(stack) > 1:
+                prev = stack.pop()
+                if DEBUG:
+                    print(f"adding {prev['node'].tag} to {stack[-1]['node'].tag}")
+                stack[-1]['node'].append(prev['node'])
+                if indent >= prev['indent']:
+                    break
+        # key/value pairs can be added as a complete child of the top of the
+        # stack
+        if key and val:
+            node = ET.SubElement(stack[-1]['node'], key)
+            node.text = val.strip()
+            prev_node = node
+        # bare keys mean we need push a new node to the stack, b/c the next
+        # lines will be children
+        elif key:
+            node = ET.Element(key)
+            stack.append({'node': node, 'indent': indent})
+            prev_node = node
+        # bare values should be added as text for the most recent node
+        elif prev_node.text:
+            prev_node.text = f"{prev_node.text}\n{val}"
+        else:
+            prev_node.text = val
+        if key:
+            prev_indent = indent
+    # close any remaining elements on the stack
+    while len(stack) > 1:
+        prev = stack.pop()
+        stack[-1]['node'].append(prev['node'])
+    return ET.ElementTree(root)
+
+
+def parse_met(path):
+    """Parse a USGS metadata text file into an ElementTree
+
+    Results are cached until the file changes, so treat the tree as read-only.
+    """
+    return _parse_met(os.path.realpath(path), os.path.getmtime(path))
+
+
+@lru_cache(maxsize=16)
+def _parse_met(path, _mtime):
+    # Most of these are UTF-8 but some are latin-1, and we don't find out
+    # until we hit a character we can't decode
+    try:
+        with open(path, encoding="utf-8") as met_file:
+            return parse_met_lines(met_file)
+    except UnicodeDecodeError:
+        with open(path, encoding="latin-1") as met_file:
+            return parse_met_lines(met_file)
+
+
+def enumerated_domains(path, attribute_label="PTYPE"):
+    """List the enumerated values and definitions for an attribute in a met file
+
+    Returns a tuple of (value, definition) tuples, skipping domains missing
+    either.
+    """
+    return _enumerated_domains(
+        os.path.realpath(path),
+        os.path.getmtime(path),
+        attribute_label
+    )
+
+
+@lru_cache(maxsize=16)
+def _enumerated_domains(path, mtime, attribute_label):
+    tree = _parse_met(path, mtime)
+    xpath = f'.//Attribute[Attribute_Label="{attribute_label}"]//Enumerated_Domain'
+    domains = []
+    for enumerated_domain in tree.iterfind(xpath):
+        edv = enumerated_domain.find('Enumerated_Domain_Value')
+        edvd = enumerated_domain.find('Enumerated_Domain_Value_Definition')
+        if edv is None or edvd is None or edv.text is None or edvd.text is None:
+            continue
+        domains.append((edv.text, edvd.text))
+    return tuple(domains)
@@ -0,0 +1,530 @@
+"""
+Compact, integer-indexed graph of the flow between waterways
+
+Waterways are identified by the integer ids of the waterways table, which are
+the same ids that end up in the tiles. Internally those ids get mapped to
+dense indexes from 0 to N - 1 so adjacency can be stored in compressed sparse
+row (CSR) form, i.e. a flat array of neighbors and an array of offsets into it
+for each node, instead of millions of strings.
+"""
+
+import os
+import sqlite3
+from array import array
+from bisect import bisect_left
+
+# Row count per executemany when writing to SQLite
+BATCH_SIZE = 10_000
+
+
+def insert_rows(con, table_name, rows, num_columns):
+    """Insert rows from an iterable into a SQLite table in batches"""
+    sql = f"INSERT INTO {table_name} VALUES ({', '.join(['?'] * num_columns)})"
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            con.executemany(sql, batch)
+            batch = []
+    if batch:
+        con.executemany(sql, batch)
+
+
+def build_csr(num_nodes, sources, targets):
+    """Build CSR arrays for edges from sources[i] to targets[i]
+
+    Returns a tuple of (offsets, neighbors) where the neighbors of node n are
+    neighbors[offsets[n]:offsets[n + 1]]
+    """
+    offsets = array("L", [0]) * (num_nodes + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for idx in range(num_nodes):
+        offsets[idx + 1] += offsets[idx]
+    neighbors = array("L", [0]) * len(sources)
+    cursor = array("L", offsets[:-1])
+    for source, target in zip(sources, targets):
+        neighbors[cursor[source]] = target
+        cursor[source] += 1
+    return offsets, neighbors
+
+
+class Network:
+    """Directed graph of waterways flowing into one another
+
+    Args:
+      edges: iterable of (id, to_id) tuples of waterway ids where water
+        flows from id to to_id
+    """
+
+    def __init__(self, edges):
+        edges = set(edges)
+        self.self_loops = sum(1 for from_id, to_id in edges if from_id == to_id)
+        edges = sorted((from_id, to_id) for from_id, to_id in edges if from_id != to_id)
+        self.ids = array("q", sorted({wid for edge in edges for wid in edge}))
+        sources = array("L", [self.index(from_id) for from_id, _ in edges])
+        targets = array("L", [self.index(to_id) for _, to_id in edges])
+        self.down_offsets, self.down_neighbors = build_csr(len(self.ids), sources, targets)
+        self.up_offsets, self.up_neighbors = build_csr(len(self.ids), targets, sources)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_edges(self):
+        """Number of distinct edges in the graph, not counting self-loops"""
+        return len(self.down_neighbors)
+
+    def index(self, waterway_id):
+        """Dense index for a waterway id, or None if it's not in the graph"""
+        idx = bisect_left(self.ids, waterway_id)
+        if idx < len(self.ids) and self.ids[idx] == waterway_id:
+            return idx
+        return None
+
+    def downstream(self, idx):
+        """Indexes of the nodes immediately downstream of a node"""
+        return self.down_neighbors[self.down_offsets[idx]:self.down_offsets[idx + 1]]
+
+    def upstream(self, idx):
+        """Indexes of the nodes immediately upstream of a node"""
+        return self.up_neighbors[self.up_offsets[idx]:self.up_offsets[idx + 1]]
+
+    def edges(self):
+        """Yield (id, to_id) tuples of waterway ids"""
+        for idx, waterway_id in enumerate(self.ids):
+            for to_idx in self.downstream(idx):
+                yield (waterway_id, self.ids[to_idx])
+
+    def components(self):
+        """Label each node with the weakly connected component it's in
+
+        Returns an array of component labels, one per node
+        """
+        parents = array("L", range(len(self.ids)))
+
+        def find(idx):
+            while parents[idx] != idx:
+                parents[idx] = parents[parents[idx]]
+                idx = parents[idx]
+            return idx
+
+        for idx in range(len(self.ids)):
+            for to_idx in self.downstream(idx):
+                root, to_root = find(idx), find(to_idx)
+                if root != to_root:
+                    parents[max(root, to_root)] = min(root, to_root)
+        return array("L", [find(idx) for idx in range(len(self.ids))])
+
+    def validate(self):
+        """Summarize the shape of the graph so problems are easy to spot"""
+        outlets = sum(
+            1 for idx in range(len(self.ids))
+            if self.down_offsets[idx] == self.down_offsets[idx + 1]
+        )
+        headwaters = sum(
+            1 for idx in range(len(self.ids))
+            if self.up_offsets[idx] == self.up_offsets[idx + 1]
+        )
+        return {
+            "nodes": len(self.ids),
+            "edges": self.num_edges,
+            "self_loops": self.self_loops,
+            "components": len(set(self.components())),
+            "outlets": outlets,
+            "headwaters": headwaters
+        }
+
+
+def network_from_rows(rows):
+    """Build a Network from (id, to_id, has_to) rows, counting dangling refs
+
+    A row is dangling if its id is null, i.e. the network refers to a waterway
+    we don't have, or if it should point downstream (has_to) but to_id is
+    null. Returns a tuple of (network, num_dangling)
+    """
+    dangling = 0
+    edges = []
+    for waterway_id, to_id, has_to in rows:
+        if waterway_id is None or (has_to and to_id is None):
+            dangling += 1
+            continue
+        if to_id is not None:
+            edges.append((waterway_id, to_id))
+    return Network(edges), dangling
+
+
+def write_network_to_sqlite(network, path, table_name="waterways_network"):
+    """Write the graph as a typed adjacency table to a SQLite file like an MBTiles
+
+    Each row is an edge from id to to_id, both waterway ids. The table is
+    WITHOUT ROWID so the primary key is the table, which makes downstream
+    lookups a single b-tree search, and there's a covering index on to_id for
+    going upstream.
+    """
+    con = sqlite3.connect(path)
+    try:
+        con.execute(f"DROP TABLE IF EXISTS {table_name}")
+        con.execute(f"""
+            CREATE TABLE {table_name} (
+                id INTEGER NOT NULL,
+                to_id INTEGER NOT NULL,
+                PRIMARY KEY (id, to_id)
+            ) WITHOUT ROWID
+        """)
+        insert_rows(con, table_name, network.edges(), 2)
+        con.execute(f"CREATE INDEX {table_name}_to_id ON {table_name} (to_id, id)")
+        con.commit()
+    finally:
+        con.close()
+    return os.path.realpath(path)
+
+
+def flow_successors(network):
+    """Pick a single downstream node for every node in the network
+
+    Where a waterway splits we follow the downstream node with the lowest
+    index, which is the lowest waterway id. Returns an array with the index of
+    each node's successor, or -1 for outlets.
+    """
+    successors = array("l", [-1]) * len(network)
+    for idx in range(len(network)):
+        downstream = network.downstream(idx)
+        if downstream:
+            successors[idx] = min(downstream)
+    return successors
+
+
+def flow_outlets(successors):
+    """Find the outlet and number of hops to it for every node
+
+    Chains are resolved with path compression so every node is visited a
+    constant number of times. Successors that would close a loop get cut, so
+    the node where the loop was detected acts as an outlet.
+
+    Returns a tuple of (outlets, hops) arrays
+    """
+    num_nodes = len(successors)
+    outlets = array("l", [-1]) * num_nodes
+    hops = array("l", [-1]) * num_nodes
+    # 0 for unvisited, 1 for on the current walk, 2 for resolved
+    state = array("b", [0]) * num_nodes
+    for start in range(num_nodes):
+        if state[start]:
+            continue
+        walk = []
+        idx = start
+        while idx != -1 and state[idx] == 0:
+            state[idx] = 1
+            walk.append(idx)
+            idx = successors[idx]
+        if idx == -1:
+            outlet, hop = walk[-1], 0
+            walk.pop()
+            outlets[outlet], hops[outlet], state[outlet] = outlet, 0, 2
+        elif state[idx] == 1:
+            # Loop: cut it at the node we came back to
+            successors[walk[-1]] = -1
+            outlet, hop = walk[-1], 0
+            walk.pop()
+            outlets[outlet], hops[outlet], state[outlet] = outlet, 0, 2
+        else:
+            outlet, hop = outlets[idx], hops[idx]
+        for node in reversed(walk):
+            hop += 1
+            outlets[node], hops[node], state[node] = outlet, hop, 2
+    return outlets, hops
+
+
+def flow_paths(network):
+    """Decompose downstream flow into shared paths
+
+    Every node's route to its outlet is stored once per path instead of once
+    per node. Paths follow the largest upstream branch at every confluence
+    (heavy path decomposition), so any route to an outlet only switches paths
+    O(log N) times, and the whole thing runs in linear time.
+
+    Returns a dict of arrays:
+      successors: index of the downstream node or -1
+      outlets: index of the outlet node
+      hops: number of nodes between a node and its outlet
+      path_ids: path of each node
+      path_positions: position of each node in its path
+      paths: list of arrays of node indexes in downstream order
+      path_successors: tuple of (path id, position) each path drains into, or
+        None for paths ending at an outlet
+    """
+    num_nodes = len(network)
+    successors = flow_successors(network)
+    outlets, hops = flow_outlets(successors)
+    # Order nodes from farthest upstream to the outlets with a counting sort
+    max_hops = max(hops) if num_nodes else 0
+    buckets = [[] for _ in range(max_hops + 1)]
+    for idx in range(num_nodes):
+        buckets[hops[idx]].append(idx)
+    sizes = array("L", [1]) * num_nodes
+    heavy = array("l", [-1]) * num_nodes
+    for bucket in reversed(buckets):
+        for idx in bucket:
+            succ = successors[idx]
+            if succ == -1:
+                continue
+            sizes[succ] += sizes[idx]
+            if heavy[succ] == -1 or sizes[idx] > sizes[heavy[succ]]:
+                heavy[succ] = idx
+    # Paths end where a node isn't its successor's heaviest branch, and we
+    # build them outlets first so a path's successor path always exists
+    path_ids = array("l", [-1]) * num_nodes
+    path_positions = array("l", [-1]) * num_nodes
+    paths = []
+    path_successors = []
+    for bucket in buckets:
+        for end in bucket:
+            succ = successors[end]
+            if succ != -1 and heavy[succ] == end:
+                continue
+            path = array("L")
+            idx = end
+            while idx != -1:
+                path.append(idx)
+                idx = heavy[idx]
+            path.reverse()
+            path_id = len(paths)
+            for position, idx in enumerate(path):
+                path_ids[idx] = path_id
+                path_positions[idx] = position
+            paths.append(path)
+            path_successors.append(
+                None if succ == -1 else (path_ids[succ], path_positions[succ])
+            )
+    return {
+        "successors": successors,
+        "outlets": outlets,
+        "hops": hops,
+        "path_ids": path_ids,
+        "path_positions": path_positions,
+        "paths": paths,
+        "path_successors": path_successors
+    }
+
+
+def downstream_path(flow, idx):
+    """List the indexes of the nodes from idx to its outlet using flow_paths"""
+    route = []
+    position = flow["path_positions"][idx]
+    path_id = flow["path_ids"][idx]
+    while True:
+        route.extend(flow["paths"][path_id][position:])
+        if flow["path_successors"][path_id] is None:
+            return route
+        path_id, position = flow["path_successors"][path_id]
+
+
+def reachable(network, seed_ids, allowed_ids=None):
+    """Ids of all waterways upstream or downstream of any seed
+
+    Upstream and downstream are followed separately, so a creek flowing into
+    the same river below a seed doesn't count. Traversal stops at waterways
+    that aren't in allowed_ids if specified, and seeds are always included.
+    """
+    num_nodes = len(network)
+    allowed = None
+    if allowed_ids is not None:
+        allowed = array("b", [0]) * num_nodes
+        for waterway_id in allowed_ids:
+            idx = network.index(waterway_id)
+            if idx is not None:
+                allowed[idx] = 1
+    found = set(seed_ids)
+    seeds = [idx for idx in map(network.index, found) if idx is not None]
+    for neighbors in (network.upstream, network.downstream):
+        visited = array("b", [0]) * num_nodes
+        stack = list(seeds)
+        for idx in seeds:
+            visited[idx] = 1
+        while stack:
+            for next_idx in neighbors(stack.pop()):
+                if visited[next_idx] or (allowed is not None and not allowed[next_idx]):
+                    continue
+                visited[next_idx] = 1
+                found.add(network.ids[next_idx])
+                stack.append(next_idx)
+    return found
+
+
+def write_flow_paths_to_sqlite(network, path, table_name="waterways_flow"):
+    """Write precomputed downstream flow paths to a SQLite file like an MBTiles
+
+    Writes two tables, both WITHOUT ROWID and keyed by waterway / path ids:
+
+      {table_name}: id, to_id, outlet_id, hops, path_id, path_position
+      {table_name}_paths: path_id, to_path_id, to_path_position, and ids, a
+        comma-separated list of the waterway ids in the path in downstream
+        order
+
+    The route from a waterway to its outlet is ids[path_position:] of its
+    path, followed by ids[to_path_position:] of to_path_id, and so on, which a
+    recursive CTE can fetch in one query.
+    """
+    flow = flow_paths(network)
+    ids = network.ids
+
+    def waterway_id(idx):
+        return None if idx == -1 else ids[idx]
+
+    def node_rows():
+        for idx, wid in enumerate(ids):
+            yield (
+                wid,
+                waterway_id(flow["successors"][idx]),
+                waterway_id(flow["outlets"][idx]),
+                flow["hops"][idx],
+                flow["path_ids"][idx],
+                flow["path_positions"][idx]
+            )
+
+    def path_rows():
+        for path_id, nodes in enumerate(flow["paths"]):
+            to_path_id, to_path_position = flow["path_successors"][path_id] or (None, None)
+            yield (
+                path_id,
+                to_path_id,
+                to_path_position,
+                ",".join(str(ids[idx]) for idx in nodes)
+            )
+
+    paths_table_name = f"{table_name}_paths"
+    con = sqlite3.connect(path)
+    try:
+        con.execute(f"DROP TABLE IF EXISTS {table_name}")
+        con.execute(f"DROP TABLE IF EXISTS {paths_table_name}")
+        con.execute(f"""
+            CREATE TABLE {table_name} (
+                id INTEGER NOT NULL PRIMARY KEY,
+                to_id INTEGER,
+                outlet_id INTEGER NOT NULL,
+                hops INTEGER NOT NULL,
+                path_id INTEGER NOT NULL,
+                path_position INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        con.execute(f"""
+            CREATE TABLE {paths_table_name} (
+                path_id INTEGER NOT NULL PRIMARY KEY,
+                to_path_id INTEGER,
+                to_path_position INTEGER,
+                ids TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        insert_rows(con, table_name, node_rows(), 6)
+        insert_rows(con, paths_table_name, path_rows(), 4)
+        con.commit()
+    finally:
+        con.close()
+    return os.path.realpath(path)
+
+
+def strahler_orders(network):
+    """Compute the Strahler stream order of every node
+
+    Headwaters are order 1, and a node's order goes up by one when two or
+    more of the branches flowing into it share the highest order among them.
+    Nodes are visited in topological order from the headwaters down, so this
+    is linear. Anything stuck in a loop just gets the order of whatever flows
+    into it.
+    """
+    num_nodes = len(network)
+    orders = array("L", [1]) * num_nodes
+    # Highest upstream order and how many upstream branches have it
+    max_orders = array("L", [0]) * num_nodes
+    max_counts = array("L", [0]) * num_nodes
+    remaining = array("L", [
+        network.up_offsets[idx + 1] - network.up_offsets[idx] for idx in range(num_nodes)
+    ])
+    queue = [idx for idx in range(num_nodes) if remaining[idx] == 0]
+    visited = array("b", [0]) * num_nodes
+
+    def visit(idx):
+        visited[idx] = 1
+        if max_counts[idx] > 1:
+            orders[idx] = max_orders[idx] + 1
+        elif max_counts[idx] == 1:
+            orders[idx] = max_orders[idx]
+        for to_idx in network.downstream(idx):
+            if orders[idx] > max_orders[to_idx]:
+                max_orders[to_idx] = orders[idx]
+                max_counts[to_idx] = 1
+            elif orders[idx] == max_orders[to_idx]:
+                max_counts[to_idx] += 1
+            remaining[to_idx] -= 1
+            if remaining[to_idx] == 0:
+                queue.append(to_idx)
+
+    while queue:
+        visit(queue.pop())
+    for idx in range(num_nodes):
+        if not visited[idx]:
+            orders[idx] = max(max_orders[idx], 1)
+    return orders
+
+
+def merge_chains(network, keys):
+    """Find chains of consecutive nodes that can be merged into one
+
+    A node continues the chain of the node upstream of it if that's the only
+    thing flowing into it, it's the only place that upstream node flows, and
+    both have the same key, e.g. a tuple of attributes. Nodes with a key of
+    None never get merged.
+
+    Returns a list of arrays of node indexes in downstream order, only
+    including chains of more than one node
+    """
+    num_nodes = len(network)
+
+    def continues(idx):
+        upstream = network.upstream(idx)
+        if len(upstream) != 1:
+            return False
+        up_idx = upstream[0]
+        return (
+            len(network.downstream(up_idx)) == 1
+            and keys[idx] is not None
+            and keys[idx] == keys[up_idx]
+        )
+
+    chains = []
+    for idx in range(num_nodes):
+        if continues(idx):
+            continue
+        chain = array("L", [idx])
+        while True:
+            downstream = network.downstream(chain[-1])
+            if len(downstream) != 1 or not continues(downstream[0]):
+                break
+            chain.append(downstream[0])
+        if len(chain) > 1:
+            chains.append(chain)
+    return chains
+
+
+def write_segments_to_sqlite(rows, path, table_name="waterways_segments"):
+    """Write (id, merged_id) rows mapping network ids to merged waterway ids
+
+    Only segments that got merged into something are in the table, so a
+    missing id means the waterway was left as is.
+    """
+    con = sqlite3.connect(path)
+    try:
+        con.execute(f"DROP TABLE IF EXISTS {table_name}")
+        con.execute(f"""
+            CREATE TABLE {table_name} (
+                id INTEGER NOT NULL PRIMARY KEY,
+                merged_id INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        insert_rows(con, table_name, rows, 2)
+        con.execute(f"CREATE INDEX {table_name}_merged_id ON {table_name} (merged_id)")
+        con.commit()
+    finally:
+        con.close()
+    return os.path.realpath(path)
@@ -3,21 +3,29 @@
 import csv
 import os
 import re
+import subprocess
 from glob import glob
-import xml.etree.ElementTree as ET
+from multiprocessing import Pool
 
 import fiona
 
 from .. import (
+    archive_type_for_path,
     call_cmd,
     extless_basename,
+    extract_archive_members,
     extract_e00,
+    gdal_can_read,
     log,
     make_work_dir,
-    met2xml,
+    merge_layers,
+    NUM_PROCESSES,
     polygonize_arcs,
-    unzip
+    unzip,
+    vsi_path
 )
+from ..attributes import distinct_attributes
+from ..met import enumerated_domains
 from ..proj import NAD27_UTM10_PROJ4, SRS
 from .constants import *
 
@@ -266,19 +274,10 @@ def metadata_from_usgs_met(path):
     of the way there.
     """
     data = [METADATA_COLUMN_NAMES.copy()]
-    xml_path = met2xml(path)
-    tree = ET.parse(xml_path)
-    enumerated_domain_xpath = './/Attribute[Attribute_Label="PTYPE"]//Enumerated_Domain'
-    for enumerated_domain in tree.iterfind(enumerated_domain_xpath):
+    for code, title in enumerated_domains(path, attribute_label="PTYPE"):
         row = {col: None for col in METADATA_COLUMN_NAMES}
-        edv = enumerated_domain.find('Enumerated_Domain_Value')
-        edvd = enumerated_domain.find('Enumerated_Domain_Value_Definition')
-        if edv is None or edvd is None:
-            continue
-        row['code'] = edv.text
-        row['title'] = edvd.text
-        if row['code'] is None or row['title'] is None:
-            continue
+        row['code'] = code
+        row['title'] = title
         row['title'] = re.sub(r"\n", " ", row['title'])
         row['lithology'] = lithology_from_text(row['title'])
         row['formation'] = formation_from_text(row['title'])
@@ -395,12 +394,26 @@ def infer_metadata_from_csv_row(row):
     return row
 
 
-def infer_metadata_from_csv(infile_path):
+def codes_from_polygons(polygons_path, join_col="PTYPE"):
+    """Return the set of distinct unit codes used in a polygons file
+
+    Only reads the join column, so this is quick even for large files with
+    complex geometries.
+    """
+    return set(distinct_attributes(polygons_path, join_col, columns=[join_col]))
+
+
+def infer_metadata_from_csv(infile_path, codes=None):
     """Fill in missing metadata columns in a CSV
 
     The metadata file *can* have every column, but in general it just has the
     info that can't be inferred and we infer the rest from the title and
     description.
+
+    Polygons with uncertain units use the unit code followed by a question
+    mark, e.g. Tss?, so this also writes an uncertain version of each unit.
+    If codes is specified, only uncertain units whose codes are in it will be
+    written.
     """
     outfile_path = "data.csv"
     with open(infile_path, encoding="utf-8") as infile:
@@ -415,48 +428,79 @@ def infer_metadata_from_csv(infile_path):
             for row in reader:
                 row = infer_metadata_from_csv_row(row)
                 writer.writerow(row)
+                uncertain_code = f"{row['code']}?"
+                if codes is not None and uncertain_code not in codes:
+                    continue
                 uncertain_row = row.copy()
-                uncertain_row['code'] = f"{row['code']}?"
+                uncertain_row['code'] = uncertain_code
                 uncertain_row['title'] = f"[?] {row['title']}"
                 uncertain_row['description'] = f"[UNCERTAIN] {row['description']}"
                 writer.writerow(uncertain_row)
     return outfile_path
 
 
+def convert_e00_file_to_shapefiles(
+    path,
+    uncompress_e00=False,
+    skip_polygonize_arcs=False,
+    polygon_pattern=None,
+    procs=1
+):
+    """Convert a single ESRI E00 file to a polygons shapefile path
+
+    procs is the number of processes to polygonize arcs with
+    """
+    if uncompress_e00:
+        # Each file needs its own uncompressed copy since these might be
+        # getting processed in parallel
+        uncompressed_e00_path = f"{extless_basename(path)}-uncompressed.e00"
+        if not os.path.isfile(uncompressed_e00_path):
+            log(f"\tUncompressing {path}")
+            call_cmd([
+                "../../bin/e00compr/e00conv",
+                path,
+                uncompressed_e00_path
+            ])
+        path = uncompressed_e00_path
+    log(f"\tExtracting {path}...")
+    shapefiles_path = extract_e00(path)
+    log(f"\tshapefiles_path: {shapefiles_path}")
+    if skip_polygonize_arcs:
+        return os.path.join(shapefiles_path, "PAL.shp")
+    log(f"\tPolygonizing arcs in {shapefiles_path}...")
+    if polygon_pattern:
+        return polygonize_arcs(
+            shapefiles_path,
+            polygon_pattern=polygon_pattern,
+            procs=procs
+        )
+    return polygonize_arcs(shapefiles_path, procs=procs)
+
+
 def convert_e00_to_shapefiles(
     e00_path,
     uncompress_e00=False,
     skip_polygonize_arcs=False,
-    polygon_pattern=None
+    polygon_pattern=None,
+    procs=NUM_PROCESSES
 ):
-    """Convert an ESRI E00 file to an array of shapefile paths"""
+    """Convert ESRI E00 files matching a glob to an array of shapefile paths
+
+    Multi-sheet sources get converted in parallel processes, one per sheet,
+    and the sheets split the processes for polygonizing arcs between them. A
+    single sheet gets them all.
+    """
     log("CONVERTING E00 TO SHAPEFILES...")
-    polygon_paths = []
-    for path in glob(e00_path):
-        if uncompress_e00:
-            uncompressed_e00_path = "uncompressed.e00"
-            if not os.path.isfile(uncompressed_e00_path):
-                log("\tUncompressing e00")
-                call_cmd([
-                    "../../bin/e00compr/e00conv",
-                    path,
-                    uncompressed_e00_path
-                ])
-                path = uncompressed_e00_path
-        log("\tExtracting e00...")
-        shapefiles_path = extract_e00(path)
-        log(f"\tshapefiles_path: {shapefiles_path}")
-        log("\tPolygonizing arcs...")
-        if skip_polygonize_arcs:
-            polygon_paths.append(os.path.join(shapefiles_path, "PAL.shp"))
-        elif polygon_pattern:
-            polygon_paths.append(polygonize_arcs(
-                shapefiles_path,
-                polygon_pattern=polygon_pattern
-            ))
-        else:
-            polygon_paths.append(polygonize_arcs(shapefiles_path))
-    return polygon_paths
+    paths = glob(e00_path)
+    sheet_procs = max(1, procs // len(paths)) if paths else 1
+    args = [
+        [path, uncompress_e00, skip_polygonize_arcs, polygon_pattern, sheet_procs]
+        for path in paths
+    ]
+    if procs > 1 and len(args) > 1:
+        with Pool(processes=min(procs, len(args))) as pool:
+            return pool.starmap(convert_e00_file_to_shapefiles, args)
+    return [convert_e00_file_to_shapefiles(*file_args) for file_args in args]
 
 
 def convert_mdb_to_shapefiles(mdb_path, layer_name):
@@ -488,6 +532,24 @@ def apply_join_col_modifier(shapefile_path, join_col, join_col_modifier):
     return output_path
 
 
+def extract_archive(download_path, use_unzip=False):
+    """Extract an archive in the current directory"""
+    log("EXTRACTING ARCHIVE...")
+    if (
+        ".tar.gz" in download_path
+        or ".tgz" in download_path
+        or ".tar.Z" in download_path
+    ):
+        call_cmd(["tar", "xzvf", download_path])
+    elif use_unzip:
+        unzip(download_path)
+    else:
+        # Decompress to a new file so we keep the original download
+        extracted_path = re.sub(r"\.(gz|z|Z)$", "", download_path)
+        with open(extracted_path, "wb") as outfile:
+            subprocess.run(["gunzip", "-c", download_path], stdout=outfile, check=True)
+
+
 def process_usgs_source(
     base_path,
     url,
@@ -537,23 +599,34 @@ def process_usgs_source(
         log(f"DOWNLOADING {url}")
         call_cmd(["curl", "-OL", url])
 
-    # extract the archive if necessary
+    # read the data straight out of the archive if we can, otherwise extract
+    # the archive if necessary
+    archive_type = "zip" if use_unzip else archive_type_for_path(download_path)
+    polygons_source_path = extracted_file_path
     if len(glob(extracted_file_path)) == 0:
-        log("EXTRACTING ARCHIVE...")
-        if (
-            ".tar.gz" in download_path
-            or ".tgz" in download_path
-            or ".tar.Z" in download_path
-        ):
-            call_cmd(["tar", "xzvf", download_path])
-        elif use_unzip:
-            unzip(download_path)
+        in_place_path = None
+        if extracted_file_path.endswith(".shp"):
+            in_place_path = vsi_path(
+                download_path,
+                extracted_file_path,
+                archive_type=archive_type
+            )
+        if in_place_path and gdal_can_read(in_place_path):
+            log(f"READING {in_place_path} WITHOUT EXTRACTING...")
+            polygons_source_path = in_place_path
+            # Metadata still needs to be on disk
+            member_patterns = [
+                os.path.join(os.path.dirname(extracted_file_path), "*.met")
+            ]
+            if mappable_metadata_csv_path:
+                member_patterns.append(mappable_metadata_csv_path)
+            extract_archive_members(
+                download_path,
+                member_patterns,
+                archive_type=archive_type
+            )
         else:
-            copy_path = download_path + "-copy"
-            call_cmd(["cp", download_path, copy_path])
-            call_cmd(["gunzip", download_path])
-            call_cmd(["cp", copy_path, download_path])
-            call_cmd(["rm", copy_path])
+            extract_archive(download_path, use_unzip=use_unzip)
 
     # convert the Arc Info coverages to shapefiles
     extracted_polygons_path = "extracted_polygons.shp"
@@ -574,13 +647,11 @@ def process_usgs_source(
                 layer_name
             )
         elif extracted_file_path.endswith(".shp"):
-            polygon_paths = [extracted_file_path]
+            polygon_paths = [polygons_source_path]
         else:
             raise ValueError(f"Can't convert {extracted_file_path}")
         log("MERGING SHAPEFILES...")
-        call_cmd(["ogr2ogr", "-overwrite", extracted_polygons_path, polygon_paths.pop()])
-        for path in polygon_paths:
-            call_cmd(["ogr2ogr", "-update", "-append", extracted_polygons_path, path])
+        merge_layers(polygon_paths, extracted_polygons_path)
 
     # dissolve all the shapes by polygons_join_col and project them into Google Mercator
     log("DISSOLVING SHAPES AND REPROJECTING...")
@@ -608,8 +679,10 @@ def process_usgs_source(
     metadata_path = "data.csv"
     globs = glob(os.path.join(os.path.dirname(extracted_file_path), "*.met"))
     met_path = globs[0] if globs else None
+    if metadata_csv_path or mappable_metadata_csv_path:
+        codes = codes_from_polygons(final_polygons_path, polygons_join_col)
     if metadata_csv_path:
-        metadata_path = infer_metadata_from_csv(metadata_csv_path)
+        metadata_path = infer_metadata_from_csv(metadata_csv_path, codes=codes)
         if met_path:
             fill_in_custom_metadata_from_met(met_path, metadata_path)
     elif mappable_metadata_csv_path and mappable_metadata_mapping:
@@ -617,7 +690,7 @@ def process_usgs_source(
             mappable_metadata_csv_path,
             mappable_metadata_mapping
         )
-        metadata_path = infer_metadata_from_csv(mappable_metadata_path)
+        metadata_path = infer_metadata_from_csv(mappable_metadata_path, codes=codes)
     elif met_path:
         data = metadata_from_usgs_met(met_path)
         with open(metadata_path, "w", encoding="utf-8") as metadata_file:
@@ -640,15 +713,28 @@ def process_usgs_source(
     ])
 
 
+def fill_in_metadata_row(row, fallback_row):
+    """Fill empty columns in a metadata row with values from another row"""
+    if not fallback_row:
+        return row
+    for col in METADATA_COLUMN_NAMES:
+        if not row.get(col) and fallback_row.get(col):
+            row[col] = fallback_row[col]
+    return row
+
+
 def fill_in_custom_metadata_from_met(met_path, metadata_path):
-    """Fill gaps in existing metadata file with USGS metadata file"""
+    """Fill gaps in existing metadata file with USGS metadata file
+
+    Writes one row for each row in the existing file, keyed by code.
+    """
     met_data = metadata_from_usgs_met(met_path)
-    hashed_met_data = {}
-    for row in met_data:
-        hashed_met_data[row[0]] = dict(zip(METADATA_COLUMN_NAMES, row))
+    hashed_met_data = {
+        row[0]: dict(zip(METADATA_COLUMN_NAMES, row)) for row in met_data[1:]
+    }
+    outfile_path = "temp.csv"
     with open(metadata_path, 'r', encoding="utf-8") as infile:
         reader = csv.DictReader(infile)
-        outfile_path = "temp.csv"
         with open(outfile_path, 'w', encoding="utf-8") as outfile:
             writer = csv.DictWriter(
                 outfile,
@@ -657,13 +743,8 @@ def fill_in_custom_metadata_from_met(met_path, metadata_path):
             )
             writer.writeheader()
             for row in reader:
-                met_row = hashed_met_data.get(row['code'], None)
-                for col in METADATA_COLUMN_NAMES:
-                    if (
-                        (not row[col] or len(row[col]) == 0)
-                        and met_row
-                        and met_row[col]
-                    ):
-                        row[col] = met_row[col]
-                    writer.writerow(row)
-        os.rename(outfile_path, metadata_path)
+                writer.writerow(
+                    fill_in_metadata_row(row, hashed_met_data.get(row['code']))
+                )
+    os.rename(outfile_path, metadata_path)
+    return metadata_path
@@ -0,0 +1,71 @@
+"""Methods for cleaning up free text extracted from sources"""
+
+from collections import Counter
+from difflib import SequenceMatcher
+
+SIMILARITY_THRESHOLD = 0.80
+
+
+def remove_similar_pieces(pieces, threshold=SIMILARITY_THRESHOLD):
+    """Remove pieces of text that are near-duplicates of an earlier piece
+
+    A piece is dropped if its difflib.SequenceMatcher ratio against any
+    earlier piece is greater than threshold, so the first version of a
+    repeated sentence is the one that survives. Computing that ratio for
+    every pair is expensive, so candidates are pruned with two cheap upper
+    bounds on the ratio first: one from the lengths alone and one from the
+    overlap of the character counts, which is the same bound
+    SequenceMatcher.quick_ratio uses. Neither bound can reject a pair the
+    full comparison would have accepted, so the output is identical to
+    comparing everything with SequenceMatcher.
+
+    >>> remove_similar_pieces(["Sandstone and shale", "Sandstone and shales"])
+    ['Sandstone and shale']
+    """
+    lengths = [len(piece) for piece in pieces]
+    char_counts = [Counter(piece) for piece in pieces]
+    # SequenceMatcher does most of its setup work on the second sequence, so
+    # keep one around for each earlier piece we actually need to compare to
+    matchers = {}
+    kept = []
+    for idx, piece in enumerate(pieces):
+        length = lengths[idx]
+        similar = False
+        for prev_idx in range(idx):
+            total = length + lengths[prev_idx]
+            if total == 0:
+                # SequenceMatcher considers two empty strings identical
+                similar = threshold < 1
+                break
+            # Length prefilter: the best possible match is the whole shorter
+            # string
+            if 2.0 * min(length, lengths[prev_idx]) / total <= threshold:
+                continue
+            # Character count prefilter
+            overlap = sum((char_counts[idx] & char_counts[prev_idx]).values())
+            if 2.0 * overlap / total <= threshold:
+                continue
+            if prev_idx not in matchers:
+                matchers[prev_idx] = SequenceMatcher(None, "", pieces[prev_idx])
+            matcher = matchers[prev_idx]
+            matcher.set_seq1(piece)
+            if matcher.ratio() > threshold:
+                similar = True
+                break
+        if not similar:
+            kept.append(piece)
+    return kept
+
+
+def remove_similar_sentences(text, threshold=SIMILARITY_THRESHOLD, separator=". "):
+    """Remove near-duplicate sentences from a block of text
+
+    Handy as a callable in a mappable_metadata_mapping, e.g.
+
+        "description": lambda row: remove_similar_sentences(row["Descr"])
+    """
+    if not text:
+        return text
+    pieces = [piece.strip() for piece in text.split(separator.strip())]
+    pieces = [piece for piece in pieces if len(piece) > 0]
+    return separator.join(remove_similar_pieces(pieces, threshold=threshold)).strip()
@@ -4,13 +4,28 @@ import json
 import os
 import re
 import time
-from . import log, call_cmd, make_work_dir, SRS as UNDERFOOT_SRS
+from multiprocessing.pool import ThreadPool
+
+from . import (
+    call_cmd,
+    gdal_can_read,
+    log,
+    make_work_dir,
+    merge_layers,
+    vsi_path,
+    NUM_PROCESSES,
+    SRS as UNDERFOOT_SRS
+)
 
 SRS = "EPSG:4269"
 
 
 def download(fips):
-    """Download the data and extract it"""
+    """Download the data, returning a path OGR can read it from
+
+    Reads the shapefile straight out of the zip if possible, otherwise extracts
+    it.
+    """
     work_path = make_work_dir(os.path.realpath(__file__))
     url = f"https://www2.census.gov/geo/tiger/TIGER2020/AREAWATER/tl_2020_{fips}_areawater.zip"
     # Download the data
@@ -20,23 +35,31 @@ def download(fips):
     else:
         log(f"DOWNLOADING {url}")
         call_cmd(["curl", "-f", "-L", url, "--output", download_path])
-    # Unpack the zip
-    shp_path = os.path.join(work_path, f"tl_2020_{fips}_areawater.shp")
+    shp_fname = f"tl_2020_{fips}_areawater.shp"
+    shp_path = os.path.join(work_path, shp_fname)
     if os.path.isfile(shp_path):
         log(f"Archive already extracted at {shp_path}, skipping...")
-    else:
-        log("EXTRACTING ARCHIVE...")
-        call_cmd(["unzip", "-u", "-o", download_path, "-d", work_path])
+        return shp_path
+    in_place_shp_path = vsi_path(download_path, shp_fname)
+    if gdal_can_read(in_place_shp_path):
+        return in_place_shp_path
+    # Unpack the zip
+    log("EXTRACTING ARCHIVE...")
+    call_cmd(["unzip", "-u", "-o", download_path, "-d", work_path])
+    return shp_path
 
 
-def make_gpkg(fips, dst_path, append=False):
-    """Convert data to a GeoPackage and normalize some data"""
-    log(f"Making gpkg for {fips}, append: {append }")
+def make_gpkg(fips, dst_path, shp_path=None, gpkg_path=None):
+    """Convert data to a GeoPackage and normalize some data
+
+    Writes to waterbodies.gpkg in dst_path unless gpkg_path is specified
+    """
+    log(f"Making gpkg for {fips}")
     work_path = make_work_dir(os.path.realpath(__file__))
     basename = f"tl_2020_{fips}_areawater"
-    shp_path = os.path.join(work_path, f"{basename}.shp")
-    gpkg_path = os.path.join(dst_path, "waterbodies.gpkg")
-    if os.path.isfile(gpkg_path) and not append:
+    shp_path = shp_path or os.path.join(work_path, f"{basename}.shp")
+    gpkg_path = gpkg_path or os.path.join(dst_path, "waterbodies.gpkg")
+    if os.path.isfile(gpkg_path):
         print(f"Removing {gpkg_path}")
         os.remove(gpkg_path)
     sql = f"""
@@ -44,6 +67,7 @@ def make_gpkg(fips, dst_path, append=False):
             HYDROID AS waterbody_id,
             HYDROID AS source_id,
             'HYDROID' AS source_id_attr,
+            '{fips}' AS fips,
             CASE
             WHEN FULLNAME LIKE '%Riv' THEN REPLACE(FULLNAME, ' Riv', ' River')
             WHEN FULLNAME LIKE '%Crk' THEN REPLACE(FULLNAME, ' Crk', ' Creek')
@@ -79,8 +103,6 @@ def make_gpkg(fips, dst_path, append=False):
         "-nlt", "MULTIPOLYGON",
         "-sql", sql
     ]
-    if append:
-        cmd += ["-append"]
     call_cmd(cmd, check=True)
     return gpkg_path
 
@@ -126,11 +148,37 @@ def copy_citation(dst_path):
         json.dump(data, outfile)
 
 
-def process_tiger_water_for_fips(fips_codes, source):
-    """Generate water source data from TIGER given a list of FIPS codes"""
+def process_tiger_water_for_fips(fips_codes, source, procs=NUM_PROCESSES):
+    """Generate water source data from TIGER given a list of FIPS codes
+
+    Counties get downloaded and converted to their own GeoPackages a few at a
+    time, and then merged in one go. This often runs in a daemonic worker
+    process, and the work is all in curl and ogr2ogr anyway, so it uses
+    threads.
+    """
     dst_path = make_work_dir(source)
-    for fips in fips_codes:
-        download(fips)
-    for idx, fips in enumerate(fips_codes):
-        make_gpkg(fips, dst_path=dst_path, append=(idx > 0))
+    # Make the shared download dir up front so threads don't race to do it
+    make_work_dir(os.path.realpath(__file__))
+    with ThreadPool(processes=procs) as pool:
+        shp_paths = pool.map(download, fips_codes)
+        county_gpkg_paths = pool.starmap(
+            make_gpkg,
+            [
+                [
+                    fips,
+                    dst_path,
+                    shp_path,
+                    os.path.join(dst_path, f"waterbodies-{fips}.gpkg")
+                ]
+                for fips, shp_path in zip(fips_codes, shp_paths)
+            ]
+        )
+    merge_layers(
+        county_gpkg_paths,
+        os.path.join(dst_path, "waterbodies.gpkg"),
+        src_layer="waterbodies",
+        extra_args=["-nln", "waterbodies", "-nlt", "MULTIPOLYGON"]
+    )
+    for county_gpkg_path in county_gpkg_paths:
+        os.remove(county_gpkg_path)
     copy_citation(dst_path)
@@ -5,12 +5,16 @@ Methods for processing state-wide USGS geology files
 import csv
 import os
 import re
+from multiprocessing import Pool
+
 import pandas as pd
 from . import (
     call_cmd,
+    extless_basename,
     log,
     make_work_dir,
-    unzip
+    merge_layers,
+    NUM_PROCESSES
 )
 from .proj import SRS as DEST_SRS
 from .rocks import (
@@ -24,6 +28,16 @@ from .rocks import (
 
 SRS = "+proj=longlat +datum=NAD27 +no_defs"
 
+def extract_state_archive(state, download_path):
+    """Extract an archive into a directory for the state
+
+    States get processed in parallel, so they each need their own place to
+    extract files
+    """
+    log("EXTRACTING ARCHIVE...")
+    call_cmd(["unzip", "-u", "-o", download_path, "-d", state.lower()], check=True)
+
+
 def download_shapes(state, base_url):
     """Download and extract shapefiles"""
     log(f"DOWNLOADING SHAPEFILES FOR {state}...")
@@ -32,10 +46,9 @@ def download_shapes(state, base_url):
     if not os.path.isfile(download_path):
         log(f"DOWNLOADING {url}")
         call_cmd(["curl", "-OL", url])
-    shp_path = f"{state.lower()}geol_poly_dd.shp"
+    shp_path = os.path.join(state.lower(), f"{state.lower()}geol_poly_dd.shp")
     if not os.path.isfile(shp_path):
-        log("EXTRACTING ARCHIVE...")
-        unzip(download_path)
+        extract_state_archive(state, download_path)
     return os.path.realpath(shp_path)
 
 
@@ -47,12 +60,11 @@ def download_attributes(state, base_url):
     if not os.path.isfile(download_path):
         log(f"DOWNLOADING {url}")
         call_cmd(["curl", "-OL", url])
-    csv_path = f"{state}units.csv"
+    csv_path = os.path.join(state.lower(), f"{state}units.csv")
     if not os.path.isfile(csv_path):
-        log("EXTRACTING ARCHIVE...")
-        unzip(download_path)
+        extract_state_archive(state, download_path)
     if not os.path.isfile(csv_path):
-        csv_path = re.sub(f'^{state}', state.lower(), csv_path)
+        csv_path = os.path.join(state.lower(), f"{state.lower()}units.csv")
     if not os.path.isfile(csv_path):
         raise FileNotFoundError(f"Could not find attributes CSV in {url}")
     return os.path.realpath(csv_path)
@@ -97,24 +109,83 @@ def schemify_attributes(attributes_path):
     return os.path.realpath(outfile_path)
 
 
+def dissolve_shapes(shp_path, dissolved_path, s_srs=None):
+    """Dissolve polygons by UNIT_LINK, optionally reprojecting them"""
+    cmd = ["ogr2ogr"]
+    if s_srs:
+        cmd += ["-s_srs", s_srs, "-t_srs", DEST_SRS]
+    lyr_name = extless_basename(shp_path)
+    cmd += [
+        dissolved_path, shp_path,
+        "-overwrite",
+        "-dialect", "sqlite",
+        "-sql",
+        f"SELECT UNIT_LINK, ST_Union(geometry) as geometry FROM '{lyr_name}' GROUP BY UNIT_LINK"
+    ]
+    call_cmd(cmd, check=True)
+    return os.path.realpath(dissolved_path)
+
+
+def process_state(state, base_url):
+    """Download the files for a single state and dissolve its shapes
+
+    Returns a tuple of the path to the dissolved, reprojected shapes and the
+    path to the attributes CSV
+    """
+    shp_path = download_shapes(state, base_url)
+    log(f"DISSOLVING SHAPES AND REPROJECTING FOR {state}...")
+    dissolved_path = dissolve_shapes(
+        shp_path,
+        f"{state.lower()}_dissolved_units.shp",
+        s_srs=SRS
+    )
+    return (dissolved_path, download_attributes(state, base_url))
+
+
 def merge_shapes(paths):
-    """Merge and dissolve multiple shapefiles into a single shapefile"""
+    """Merge and dissolve multiple shapefiles into a single shapefile
+
+    Expects shapefiles that have already been dissolved and reprojected on
+    their own, so each unit shows up once per state it's in. Units in a single
+    state get copied as is and only the ones that cross state lines get
+    unioned.
+    """
     log("MERGING SHAPEFILES...")
-    merged_path = "merged_units.shp"
-    call_cmd(["ogr2ogr", "-overwrite", merged_path, paths.pop()], check=True)
-    for path in paths:
-        call_cmd(["ogr2ogr", "-update", "-append", merged_path, path])
-    log("DISSOLVING SHAPES AND REPROJECTING...")
     dissolved_path = "dissolved_units.shp"
+    if len(paths) == 1:
+        merge_layers(paths, dissolved_path)
+        return dissolved_path
+    merged_path = "merged_units.shp"
+    merge_layers(paths, merged_path)
+    lyr_name = extless_basename(merged_path)
+    dissolved_lyr_name = extless_basename(dissolved_path)
+    crossing_sql = f"SELECT UNIT_LINK FROM '{lyr_name}' GROUP BY UNIT_LINK HAVING COUNT(*) > 1"
+    log("COPYING UNITS IN A SINGLE STATE...")
     call_cmd([
         "ogr2ogr",
-        "-s_srs", SRS,
-        "-t_srs", DEST_SRS,
         dissolved_path, merged_path,
         "-overwrite",
+        "-nln", dissolved_lyr_name,
         "-dialect", "sqlite",
         "-sql",
-        "SELECT UNIT_LINK, ST_Union(geometry) as geometry FROM 'merged_units' GROUP BY UNIT_LINK"
+        f"""
+            SELECT UNIT_LINK, geometry FROM '{lyr_name}'
+            WHERE UNIT_LINK NOT IN ({crossing_sql})
+        """
+    ], check=True)
+    log("DISSOLVING UNITS THAT CROSS STATE LINES...")
+    call_cmd([
+        "ogr2ogr",
+        dissolved_path, merged_path,
+        "-append",
+        "-nln", dissolved_lyr_name,
+        "-dialect", "sqlite",
+        "-sql",
+        f"""
+            SELECT UNIT_LINK, ST_Union(geometry) AS geometry FROM '{lyr_name}'
+            WHERE UNIT_LINK IN ({crossing_sql})
+            GROUP BY UNIT_LINK
+        """
     ], check=True)
     return dissolved_path
 
@@ -156,14 +227,24 @@ def process_usgs_states(
     # URL where remote data files lives
     base_url,
     # Path to the source script that output files are being made for
-    source_path
+    source_path,
+    # Number of states to download and dissolve at the same time
+    procs=NUM_PROCESSES
 ):
     """Download and process files for states from of2006_1272"""
     work_path = make_work_dir(base_path)
     os.chdir(work_path)
-    shape_paths = [download_shapes(state, base_url) for state in states]
+    if len(states) > 1 and procs > 1:
+        with Pool(processes=min(procs, len(states))) as pool:
+            results = pool.starmap(
+                process_state,
+                [(state, base_url) for state in states]
+            )
+    else:
+        results = [process_state(state, base_url) for state in states]
+    shape_paths = [shape_path for shape_path, _ in results]
+    attribute_paths = [attribute_path for _, attribute_path in results]
     single_shapefile_path = merge_shapes(shape_paths)
-    attribute_paths = [download_attributes(state, base_url) for state in states]  # noqa: E501
     single_attributes_path = merge_attributes(attribute_paths)
     schemified_attributes_path = schemify_attributes(single_attributes_path)
     join_polygons_and_metadata(
@@ -1,21 +1,39 @@
 """Constants and functions for processing water sources"""
 
+import csv
+import io
 import json
 import os
 import re
 import shutil
+import time
+from array import array
 from glob import glob
+from multiprocessing.pool import ThreadPool
+from subprocess import CalledProcessError, PIPE, Popen
 
 import xml.etree.ElementTree as ET
 
-from . import call_cmd, extless_basename, log, make_work_dir, unzip
+from . import (
+    call_cmd,
+    extless_basename,
+    extract_archive_members,
+    gdal_can_read,
+    log,
+    make_work_dir,
+    unzip,
+    vsi_path
+)
 from .proj import GRS80_LONGLAT, SRS
 
 WATERWAYS_FNAME = "waterways.gpkg"
 WATERBODIES_FNAME = "waterbodies.gpkg"
 WATERSHEDS_FNAME = "watersheds.gpkg"
-WATERWAYS_NETWORK_FNAME = "waterways-network.sqlite"
+WATERWAYS_NETWORK_FNAME = "waterways-network.csv"
 CITATION_FNAME = "citation.json"
+# Hydrologic unit levels to extract from the Watershed Boundary Dataset, from
+# finest to coarsest
+WATERSHED_HU_LEVELS = [10, 8, 6]
 
 ARTIFACT_NAMES = [
     WATERWAYS_FNAME,
@@ -25,6 +43,27 @@ ARTIFACT_NAMES = [
     CITATION_FNAME
 ]
 
+def waterbody_source_rank(source):
+    """Sort key for sources of waterbodies when they overlap, lower is better
+
+    NHD is the most detailed and TIGER the least. Ties are broken by name so
+    no two sources ever rank the same.
+    """
+    if source.startswith("nhdplus"):
+        priority = 0
+    elif source.startswith("tiger_water"):
+        priority = 2
+    else:
+        priority = 1
+    return (priority, source)
+
+
+def preferred_sources(source, sources):
+    """Sources whose waterbodies win over this source's when they overlap"""
+    rank = waterbody_source_rank(source)
+    return [other for other in sources if waterbody_source_rank(other) < rank]
+
+
 def process_omca_creeks_source(url, dir_name, waterways_shp_path,
                                watersheds_shp_path, waterways_name_col,
                                watersheds_name_col, srs):
@@ -101,7 +140,53 @@ def process_omca_creeks_source(url, dir_name, waterways_shp_path,
         call_cmd(cmd, shell=True, check=True)
 
 
-def process_nhdplus_hr_source_waterways(gdb_path, srs):
+def read_nhd_fcodes(gdb_path):
+    """Read the NHDFcode lookup table from a GDB
+
+    Returns a dict of rows keyed by FCode as a string. Reading it once and
+    baking it into the queries is a lot cheaper than having each extraction
+    join against it in the GDB.
+    """
+    result = call_cmd(
+        ["ogr2ogr", "-f", "CSV", "/vsistdout/", gdb_path, "NHDFcode"],
+        capture_output=True,
+        text=True
+    )
+    fcodes = {}
+    for row in csv.DictReader(io.StringIO(result.stdout)):
+        fcode = str(int(float(row["FCode"])))
+        fcodes[fcode] = row
+    return fcodes
+
+
+def fcode_in(fcode_column, fcodes):
+    """SQL condition matching any of the FCodes, or nothing if there are none"""
+    if not fcodes:
+        return "0 = 1"
+    return f"{fcode_column} IN ({', '.join(fcodes)})"
+
+
+def fcode_case(fcode_column, fcodes, attribute, default):
+    """SQL CASE expression mapping FCodes to a lowercase NHDFcode attribute
+
+    Blank values fall back to default, like COALESCE(NULLIF(attr, ' '),
+    default) would in a join
+    """
+    fcodes_by_value = {}
+    for fcode, row in fcodes.items():
+        value = (row.get(attribute) or "").strip().lower() or default
+        if value != default:
+            fcodes_by_value.setdefault(value, []).append(fcode)
+    whens = []
+    for value, codes in sorted(fcodes_by_value.items()):
+        quoted_value = value.replace("'", "''")
+        whens.append(f"WHEN {fcode_column} IN ({', '.join(codes)}) THEN '{quoted_value}'")
+    if not whens:
+        return f"'{default}'"
+    return f"CASE {' '.join(whens)} ELSE '{default}' END"
+
+
+def process_nhdplus_hr_source_waterways(gdb_path, srs, fcodes):
     """Project into EPSG 4326 along with name, type, and natural attributes"""
     waterways_gpkg_path = WATERWAYS_FNAME
     if os.path.isfile(waterways_gpkg_path):
@@ -163,25 +248,19 @@ def process_nhdplus_hr_source_waterways(gdb_path, srs):
             -- SWAMP/MARSH
             OR (NHDFlowline.FCode BETWEEN 45800 AND 46602)
           ) AS is_natural,
-          LOWER(
-            COALESCE(
-              NULLIF(NHDFCode.RelationshipToSurface, ' '),
-              'surface'
-            )
-          ) AS surface,
-          LOWER(
-            COALESCE(
-              NULLIF(NHDFCode.HydrographicCategory, ' '),
-              'perennial'
-            )
-          ) AS permanence,
+          {surface} AS surface,
+          {permanence} AS permanence,
           Shape AS geom
         FROM
           NHDFlowline
-            JOIN NHDFcode ON NHDFcode.FCode = NHDFlowline.FCode
         WHERE
           NHDFlowLine.FCode NOT IN (56600, 56700)
-    """
+          AND {known_fcode}
+    """.format(
+        surface=fcode_case("NHDFlowline.FCode", fcodes, "RelationshipToSurface", "surface"),
+        permanence=fcode_case("NHDFlowline.FCode", fcodes, "HydrographicCategory", "perennial"),
+        known_fcode=fcode_in("NHDFlowline.FCode", fcodes)
+    )
     # remove comments, ogr doesn't like them
     sql = re.sub(r'--.+', "", sql)
     sql = re.sub(r'\s+', " ", sql)
@@ -200,7 +279,7 @@ def process_nhdplus_hr_source_waterways(gdb_path, srs):
     call_cmd(cmd, shell=True, check=True)
 
 
-def process_nhdplus_hr_source_waterbodies(gdb_path, srs):
+def process_nhdplus_hr_source_waterbodies(gdb_path, srs, fcodes):
     """Creates waterbodies.gpkg in the work dir"""
     waterbodies_gpkg_path = WATERBODIES_FNAME
     if os.path.isfile(waterbodies_gpkg_path):
@@ -222,25 +301,27 @@ def process_nhdplus_hr_source_waterbodies(gdb_path, srs):
           END AS type,
           NOT (
             GNIS_Name LIKE '%reservoir%'
-            OR NHDFcode.Description LIKE '%reservoir%'
+            OR {reservoir_fcode}
             OR NHDWaterbody.FType = 436
             OR NHDWaterbody.FCode = 43607
             OR NHDWaterbody.FCode = 43613
             OR NHDWaterbody.FCode = 43624
           ) AS is_natural,
-          LOWER(
-            COALESCE(
-              NULLIF(NHDFCode.HydrographicCategory, ' '),
-              'perennial'
-            )
-          ) AS permanence,
+          {permanence} AS permanence,
           Shape AS geom
         FROM
           NHDWaterbody
-            JOIN NHDFcode ON NHDFcode.FCode = NHDWaterbody.FCode
         WHERE
           NHDWaterbody.FCode NOT IN (56600, 56700)
-    """
+          AND {known_fcode}
+    """.format(
+        reservoir_fcode=fcode_in("NHDWaterbody.FCode", [
+            fcode for fcode, row in fcodes.items()
+            if "reservoir" in (row.get("Description") or "").lower()
+        ]),
+        permanence=fcode_case("NHDWaterbody.FCode", fcodes, "HydrographicCategory", "perennial"),
+        known_fcode=fcode_in("NHDWaterbody.FCode", fcodes)
+    )
     sql = re.sub(r'\s+', " ", sql)
     cmd = f"""
         ogr2ogr \
@@ -258,19 +339,27 @@ def process_nhdplus_hr_source_waterbodies(gdb_path, srs):
 
 
 def process_nhdplus_hr_source_watersheds(gdb_path, srs):
-    """Creates watersheds.gpkg in the work dir"""
+    """Creates watersheds.gpkg in the work dir
+
+    Includes the HU10, HU8, and HU6 watershed boundaries so coarser levels
+    can be shown at lower zooms, with the level in hu_level
+    """
     watersheds_gpkg_path = "watersheds.gpkg"
     if os.path.isfile(watersheds_gpkg_path):
         log(f"{watersheds_gpkg_path} exists, skipping...")
         return
-    sql = """
-        SELECT
-            Name AS name,
-            HUC10 AS source_id,
-            'HUC10' AS source_id_attr,
-            Shape AS geom
-        FROM WBDHU10
-    """
+    sql = " UNION ALL ".join([
+        f"""
+            SELECT
+                Name AS name,
+                HUC{hu_level} AS source_id,
+                'HUC{hu_level}' AS source_id_attr,
+                {hu_level} AS hu_level,
+                Shape AS geom
+            FROM WBDHU{hu_level}
+        """
+        for hu_level in WATERSHED_HU_LEVELS
+    ])
     sql = re.sub(r'\s+', " ", sql)
     cmd = f"""
         ogr2ogr \
@@ -287,50 +376,101 @@ def process_nhdplus_hr_source_watersheds(gdb_path, srs):
     call_cmd(cmd, shell=True, check=True)
 
 
+def read_vaa_nodes(lines):
+    """Read NHDPlusID, FromNode, and ToNode columns from CSV lines into arrays
+
+    Missing values come through as -1
+    """
+    def to_int(value):
+        return int(float(value)) if value else -1
+
+    ids = array("q")
+    from_nodes = array("q")
+    to_nodes = array("q")
+    for row in csv.DictReader(lines):
+        ids.append(to_int(row["NHDPlusID"]))
+        from_nodes.append(to_int(row["FromNode"]))
+        to_nodes.append(to_int(row["ToNode"]))
+    return ids, from_nodes, to_nodes
+
+
+def index_nodes(nodes):
+    """Hash table of rows by node as a dict of the first row index for each
+    node and an array of the next row index with the same node, or -1"""
+    first = {}
+    following = array("l", [-1]) * len(nodes)
+    for idx in range(len(nodes) - 1, -1, -1):
+        node = nodes[idx]
+        if node == -1:
+            continue
+        if node in first:
+            following[idx] = first[node]
+        first[node] = idx
+    return first, following
+
+
+def matching_rows(index, node):
+    """Row indexes in a node index for a node"""
+    first, following = index
+    idx = first.get(node, -1)
+    matches = []
+    while idx != -1:
+        matches.append(idx)
+        idx = following[idx]
+    return matches
+
+
+def waterways_network_edges(ids, from_nodes, to_nodes):
+    """Yield (source_id, to_source_id, from_source_id) rows for each segment
+
+    This is the equivalent of LEFT JOINing the VAA table to itself on
+    FromNode = ToNode in both directions, done with in-memory hash tables. The
+    segment downstream (to_source_id) is the one whose FromNode is this
+    segment's ToNode, and the segment upstream (from_source_id) is the one
+    whose ToNode is this segment's FromNode.
+    """
+    by_from_node = index_nodes(from_nodes)
+    by_to_node = index_nodes(to_nodes)
+    for idx, source_id in enumerate(ids):
+        downstream = [ids[match] for match in matching_rows(by_from_node, to_nodes[idx])]
+        upstream = [ids[match] for match in matching_rows(by_to_node, from_nodes[idx])]
+        for to_source_id in downstream or [None]:
+            for from_source_id in upstream or [None]:
+                yield (source_id, to_source_id, from_source_id)
+
+
 def process_nhdplus_hr_source_waterways_network(gdb_path):
-    """Adds waterways-network.csv to the work dir given Underfoot water GDB"""
-    sqlite_path = WATERWAYS_NETWORK_FNAME
-    if not os.path.isfile(sqlite_path):
-        # Extract network data from the GDB to a sqlite database that we can
-        # index for efficient queries
-        call_cmd(
-            f"ogr2ogr {sqlite_path} {gdb_path} NHDPlusFlowlineVAA",
-            shell=True
-        )
-        # Make those indexes
-        call_cmd(
-            f"sqlite3 {sqlite_path} 'CREATE INDEX vaa_tonode ON "
-            "NHDPlusFlowlineVAA (ToNode)'",
-            shell=True
-        )
-        call_cmd(
-            f"sqlite3 {sqlite_path} 'CREATE INDEX vaa_fromnode ON "
-            "NHDPlusFlowlineVAA (FromNode)'",
-            shell=True
-        )
-    csv_path = "waterways-network.csv"
-    if not os.path.isfile(csv_path):
-        # Dump the network from sqlite to CSV. Each segment has an NHDPlusID,
-        # and we're storing the NHDPlusID of the segment upstream
-        # (from_source_id) and downstream (to_source_id). You don't technically
-        # need both to construct the graph, but they save a lot of calculation
-        sql = """
-            SELECT
-                CAST(a.NHDPlusID AS INTEGER) AS source_id,
-                CAST(t.NHDPlusID AS INTEGER) AS to_source_id,
-                CAST(f.NHDPlusID AS INTEGER) AS from_source_id
-            FROM
-                NHDPlusFlowlineVAA a
-                    LEFT JOIN NHDPlusFlowlineVAA t ON t.FromNode = a.ToNode
-                    LEFT JOIN NHDPlusFlowlineVAA f ON f.ToNode = a.FromNode
-        """
-        sql = re.sub(r'\s+', " ", sql)
-        call_cmd(
-            f"""
-                sqlite3 {sqlite_path} -csv -header "{sql}" > {csv_path}
-            """,
-            shell=True
-        )
+    """Adds waterways-network.csv to the work dir given Underfoot water GDB
+
+    The VAA layer gets streamed out of the GDB once and joined in memory
+    """
+    csv_path = WATERWAYS_NETWORK_FNAME
+    if os.path.isfile(csv_path):
+        log(f"{csv_path} exists, skipping...")
+        return
+    cmd = [
+        "ogr2ogr",
+        "-f", "CSV",
+        "/vsistdout/",
+        gdb_path,
+        "NHDPlusFlowlineVAA",
+        "-select", "NHDPlusID,FromNode,ToNode"
+    ]
+    log(f"Streaming `{' '.join(cmd)}`")
+    with Popen(cmd, stdout=PIPE, text=True) as proc:
+        ids, from_nodes, to_nodes = read_vaa_nodes(proc.stdout)
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd)
+    # Each segment has an NHDPlusID, and we're storing the NHDPlusID of the
+    # segment upstream (from_source_id) and downstream (to_source_id). You
+    # don't technically need both to construct the graph, but they save a lot
+    # of calculation
+    tmp_path = f"{csv_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["source_id", "to_source_id", "from_source_id"])
+        writer.writerows(waterways_network_edges(ids, from_nodes, to_nodes))
+    os.rename(tmp_path, csv_path)
 
 
 def process_nhdplus_hr_source_citation(url):
@@ -394,6 +534,14 @@ def artifacts_generated(work_path):
     return True
 
 
+def timed(func, args):
+    """Call a function and log how long it took"""
+    start = time.time()
+    result = func(*args)
+    log(f"{func.__name__} took {round(time.time() - start, 2)}s")
+    return result
+
+
 def process_nhdplus_hr_source(
         base_path,
         url,
@@ -413,17 +561,33 @@ def process_nhdplus_hr_source(
     else:
         log(f"DOWNLOADING {url}")
         call_cmd(["curl", "-OL", url])
-    # Unpack the waterways data
+    # Read the GDB straight out of the zip if we can, since these are huge,
+    # otherwise unpack the waterways data
     gdb_path = gdb_name
+    in_place_gdb_path = vsi_path(download_path, gdb_name, archive_type="zip")
     if os.path.isdir(gdb_path):
         log(f"Archive already extracted at {gdb_path}, skipping...")
+    elif gdal_can_read(in_place_gdb_path):
+        log(f"Reading {in_place_gdb_path} without extracting...")
+        gdb_path = in_place_gdb_path
+        # The metadata still needs to be on disk for the citation
+        extract_archive_members(download_path, ["*_GDB.xml"])
     else:
         log("EXTRACTING ARCHIVE...")
         call_cmd(["unzip", "-u", "-o", download_path])
-    process_nhdplus_hr_source_waterways(gdb_path, srs)
-    process_nhdplus_hr_source_waterbodies(gdb_path, srs)
-    process_nhdplus_hr_source_watersheds(gdb_path, srs)
-    process_nhdplus_hr_source_waterways_network(gdb_path)
+    # Each of these scans a different layer of the GDB, so run them at the
+    # same time. These are just waiting on ogr2ogr, and this often runs in a
+    # daemonic worker process that can't have children of its own, so threads
+    # are fine
+    fcodes = read_nhd_fcodes(gdb_path)
+    extractions = [
+        (process_nhdplus_hr_source_waterways, [gdb_path, srs, fcodes]),
+        (process_nhdplus_hr_source_waterbodies, [gdb_path, srs, fcodes]),
+        (process_nhdplus_hr_source_watersheds, [gdb_path, srs]),
+        (process_nhdplus_hr_source_waterways_network, [gdb_path])
+    ]
+    with ThreadPool(processes=len(extractions)) as pool:
+        pool.starmap(timed, extractions)
     process_nhdplus_hr_source_citation(url)
     if not artifacts_generated(work_path):
         raise FileNotFoundError(f"Failed tobuild artifacts for {gdb_name}")
@@ -0,0 +1,72 @@
+# pylint: disable=missing-function-docstring
+"""Tests for sources.util.arcs"""
+import fiona
+import pytest
+
+from sources.util import arcs
+
+# Two unit squares side by side, polygons 2 and 3, with polygon 1 being the
+# universe polygon outside them
+ARCS = [
+    ([(0, 0), (0, 1)], 1, 2),
+    ([(0, 1), (1, 1)], 1, 2),
+    ([(1, 0), (0, 0)], 1, 2),
+    ([(1, 0), (1, 1)], 2, 3),
+    ([(1, 1), (2, 1), (2, 0)], 1, 3),
+    ([(2, 0), (1, 0)], 1, 3),
+]
+
+
+def arc_features():
+    return [
+        {
+            "properties": {"LPOLY_": lpoly, "RPOLY_": rpoly},
+            "geometry": {"type": "LineString", "coordinates": coords}
+        }
+        for coords, lpoly, rpoly in ARCS
+    ]
+
+
+def test_index_arcs_indexes_both_sides_of_arcs():
+    index = arcs.index_arcs(arc_features())
+    assert len(index[1]) == 5
+    assert len(index[2]) == 4
+    assert len(index[3]) == 3
+
+
+def write_coverage(tmp_path):
+    arc_path = str(tmp_path / "ARC.shp")
+    pal_path = str(tmp_path / "PAL.shp")
+    arc_schema = {"geometry": "LineString", "properties": {"LPOLY_": "int", "RPOLY_": "int"}}
+    with fiona.open(arc_path, "w", "ESRI Shapefile", arc_schema) as arc:
+        arc.writerecords(arc_features())
+    pal_schema = {"geometry": "Point", "properties": {"TEST-ID": "int", "PTYPE": "str"}}
+    with fiona.open(pal_path, "w", "ESRI Shapefile", pal_schema) as pal:
+        pal.writerecords([
+            {
+                "properties": {"TEST-ID": polygon_id, "PTYPE": ptype},
+                "geometry": {"type": "Point", "coordinates": (0, 0)}
+            }
+            for polygon_id, ptype in [(2, "Tss"), (3, "Kjf")]
+        ])
+    return pal_path, arc_path
+
+
+def read_polygons(path):
+    with fiona.open(path) as output:
+        return [
+            (dict(feature["properties"]), feature["geometry"]["coordinates"])
+            for feature in output
+        ]
+
+
+@pytest.mark.parametrize("procs", [1, 2])
+def test_polygonize_arcs(tmp_path, procs):
+    pal_path, arc_path = write_coverage(tmp_path)
+    serial_path = str(tmp_path / "serial.shp")
+    output_path = str(tmp_path / "polygons.shp")
+    arcs.polygonize_arcs(serial_path, pal_path, arc_path, polygon_pattern=".+-ID$")
+    arcs.polygonize_arcs(output_path, pal_path, arc_path, polygon_pattern=".+-ID$", procs=procs)
+    polygons = read_polygons(output_path)
+    assert sorted(properties["PTYPE"] for properties, _coords in polygons) == ["Kjf", "Tss"]
+    assert polygons == read_polygons(serial_path)
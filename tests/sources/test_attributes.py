@@ -0,0 +1,44 @@
+# pylint: disable=missing-function-docstring
+"""Tests for sources.util.attributes"""
+import fiona
+import pytest
+
+from sources.util import attributes
+
+SCHEMA = {
+    "geometry": "Point",
+    "properties": {"MapUnit": "str", "Formation": "str", "Com": "str"}
+}
+UNITS = [
+    ("Qal", "Alluvium", "first"),
+    ("Tv", "Volcanics", "first"),
+    ("Qal", "Alluvium", "second"),
+    ("", "Nothing", "first"),
+]
+
+
+@pytest.fixture(params=["ESRI Shapefile", "GeoJSON"])
+def units_path(request, tmp_path):
+    ext = "shp" if request.param == "ESRI Shapefile" else "geojson"
+    path = str(tmp_path / f"units.{ext}")
+    with fiona.open(path, "w", driver=request.param, schema=SCHEMA) as units:
+        units.writerecords([
+            {
+                "properties": {"MapUnit": code, "Formation": formation, "Com": com},
+                "geometry": {"type": "Point", "coordinates": (0, 0)}
+            }
+            for code, formation, com in UNITS
+        ])
+    return path
+
+
+def test_read_attributes_only_returns_requested_columns(units_path):
+    rows = list(attributes.read_attributes(units_path, columns=["MapUnit"]))
+    assert all(list(row) == ["MapUnit"] for row in rows)
+    assert [row["MapUnit"] for row in rows[:3]] == ["Qal", "Tv", "Qal"]
+
+
+def test_distinct_attributes_keeps_first_row_per_key(units_path):
+    distinct = attributes.distinct_attributes(units_path, "MapUnit", columns=["Com"])
+    assert list(distinct) == ["Qal", "Tv"]
+    assert distinct["Qal"] == {"MapUnit": "Qal", "Com": "first"}
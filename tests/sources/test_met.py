@@ -0,0 +1,66 @@
+# pylint: disable=missing-function-docstring
+"""Tests for sources.util.met"""
+import os
+
+from sources.util import met
+
+MET = """Identification_Information:
+  Citation:
+    Citation_Information:
+      Originator: Someone
+      Title:
+        Geologic map of somewhere
+Entity_and_Attribute_Information:
+  Detailed_Description:
+    Attribute:
+      Attribute_Label: PTYPE
+      Attribute_Domain_Values:
+        Enumerated_Domain:
+          Enumerated_Domain_Value: Tss
+          Enumerated_Domain_Value_Definition:
+            Sandstone and
+            shale
+        Enumerated_Domain:
+          Enumerated_Domain_Value: Kjf
+          Enumerated_Domain_Value_Definition: Franciscan Complex
+    Attribute:
+      Attribute_Label: OTHER
+      Attribute_Domain_Values:
+        Enumerated_Domain:
+          Enumerated_Domain_Value: nope
+          Enumerated_Domain_Value_Definition: Not a unit
+"""
+
+
+def write_met(tmp_path, content=MET, encoding="utf-8"):
+    path = tmp_path / "test.met"
+    path.write_text(content, encoding=encoding)
+    return str(path)
+
+
+def test_parse_met_parses_every_section(tmp_path):
+    tree = met.parse_met(write_met(tmp_path))
+    assert tree.find(".//Originator").text == "Someone"
+    assert tree.find(".//Title").text == "Geologic map of somewhere"
+    assert len(tree.findall(".//Attribute")) == 2
+
+
+def test_enumerated_domains(tmp_path):
+    assert met.enumerated_domains(write_met(tmp_path)) == (
+        ("Tss", "Sandstone and\nshale"),
+        ("Kjf", "Franciscan Complex"),
+    )
+
+
+def test_parse_met_falls_back_to_latin_1(tmp_path):
+    path = write_met(tmp_path, MET.replace("Someone", "Señor"), encoding="latin-1")
+    assert met.parse_met(path).find(".//Originator").text == "Señor"
+
+
+def test_enumerated_domains_reparses_changed_files(tmp_path):
+    path = write_met(tmp_path)
+    assert len(met.enumerated_domains(path)) == 2
+    write_met(tmp_path, MET.replace("Kjf", "Kjm"))
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    assert met.enumerated_domains(path)[1][0] == "Kjm"
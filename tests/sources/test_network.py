@@ -0,0 +1,156 @@
+# pylint: disable=missing-function-docstring
+"""Tests for sources.util.network"""
+import sqlite3
+from array import array
+
+from sources.util import network
+
+# Two creeks joining into a river, plus a separate creek draining on its own
+#
+#   10 \
+#       30 -> 40
+#   20 /
+#   50 -> 60
+EDGES = [(10, 30), (20, 30), (30, 40), (50, 60)]
+
+
+def test_build_csr():
+    offsets, neighbors = network.build_csr(3, [0, 0, 2], [1, 2, 1])
+    assert list(offsets) == [0, 2, 2, 3]
+    assert sorted(neighbors[offsets[0]:offsets[1]]) == [1, 2]
+    assert list(neighbors[offsets[2]:offsets[3]]) == [1]
+
+
+def test_network_maps_ids_to_dense_indexes():
+    graph = network.Network(EDGES)
+    assert len(graph) == 6
+    assert [graph.index(wid) for wid in [10, 20, 30, 40, 50, 60]] == list(range(6))
+    assert graph.index(35) is None
+
+
+def test_network_traverses_both_directions():
+    graph = network.Network(EDGES)
+    river = graph.index(30)
+    assert [graph.ids[idx] for idx in graph.downstream(river)] == [40]
+    assert sorted(graph.ids[idx] for idx in graph.upstream(river)) == [10, 20]
+
+
+def test_validate():
+    graph = network.Network(EDGES + [(10, 30), (40, 40)])
+    assert graph.validate() == {
+        "nodes": 6,
+        "edges": 4,
+        "self_loops": 1,
+        "components": 2,
+        "outlets": 2,
+        "headwaters": 3
+    }
+
+
+def test_network_from_rows_counts_dangling_references():
+    rows = [(10, 30, True), (30, None, False), (None, None, True), (20, None, True)]
+    graph, num_dangling = network.network_from_rows(rows)
+    assert list(graph.edges()) == [(10, 30)]
+    assert num_dangling == 2
+
+
+def test_write_network_to_sqlite(tmp_path):
+    path = str(tmp_path / "water.mbtiles")
+    network.write_network_to_sqlite(network.Network(EDGES), path)
+    con = sqlite3.connect(path)
+    assert con.execute(
+        "SELECT to_id FROM waterways_network WHERE id = 30"
+    ).fetchall() == [(40,)]
+    assert con.execute(
+        "SELECT id FROM waterways_network WHERE to_id = 30 ORDER BY id"
+    ).fetchall() == [(10,), (20,)]
+    sql = con.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'waterways_network'"
+    ).fetchone()[0]
+    assert "WITHOUT ROWID" in sql
+
+
+def test_flow_outlets_cuts_loops():
+    successors = array("l", [1, 2, 0, 2])
+    outlets, hops = network.flow_outlets(successors)
+    assert list(successors) == [1, 2, -1, 2]
+    assert list(outlets) == [2, 2, 2, 2]
+    assert list(hops) == [2, 1, 0, 1]
+
+
+def test_flow_paths_follow_every_node_to_its_outlet():
+    graph = network.Network(EDGES + [(5, 10), (40, 45)])
+    flow = network.flow_paths(graph)
+    for idx in range(len(graph)):
+        route = network.downstream_path(flow, idx)
+        assert route[0] == idx
+        assert route[-1] == flow["outlets"][idx]
+        assert len(route) == flow["hops"][idx] + 1
+    route = network.downstream_path(flow, graph.index(20))
+    assert [graph.ids[idx] for idx in route] == [20, 30, 40, 45]
+    # The heaviest branch above 30 is 10, so 5, 10, 30, 40, 45 share a path
+    assert len(flow["paths"]) == 3
+
+
+def test_write_flow_paths_to_sqlite(tmp_path):
+    path = str(tmp_path / "water.mbtiles")
+    network.write_flow_paths_to_sqlite(network.Network(EDGES), path)
+    con = sqlite3.connect(path)
+    assert con.execute(
+        "SELECT to_id, outlet_id, hops FROM waterways_flow WHERE id = 20"
+    ).fetchone() == (30, 40, 2)
+    route = con.execute("""
+        WITH RECURSIVE route(path_id, position) AS (
+            SELECT path_id, path_position FROM waterways_flow WHERE id = 20
+            UNION ALL
+            SELECT p.to_path_id, p.to_path_position
+            FROM waterways_flow_paths p JOIN route ON p.path_id = route.path_id
+            WHERE p.to_path_id IS NOT NULL
+        )
+        SELECT ids, position FROM route JOIN waterways_flow_paths USING (path_id)
+    """).fetchall()
+    ids = [wid for ids, position in route for wid in ids.split(",")[position:]]
+    assert ids == ["20", "30", "40"]
+
+
+def test_reachable_follows_flow_both_ways_but_not_sideways():
+    graph = network.Network(EDGES)
+    assert network.reachable(graph, [10]) == {10, 30, 40}
+    assert network.reachable(graph, [30]) == {10, 20, 30, 40}
+    assert network.reachable(graph, [60, 99]) == {50, 60, 99}
+
+
+def test_reachable_stays_within_allowed_ids():
+    graph = network.Network(EDGES)
+    assert network.reachable(graph, [30], allowed_ids=[20, 30]) == {20, 30}
+
+
+def test_strahler_orders():
+    # 10 and 20 are order 1 and meet at 30, making it order 2. 25 joins 30 at
+    # 40 but doesn't change its order
+    graph = network.Network(EDGES + [(25, 40)])
+    orders = network.strahler_orders(graph)
+    assert {graph.ids[idx]: order for idx, order in enumerate(orders)} == {
+        10: 1, 20: 1, 25: 1, 30: 2, 40: 2, 50: 1, 60: 1
+    }
+
+
+def test_merge_chains():
+    graph = network.Network(EDGES + [(5, 10), (40, 45)])
+    keys = {5: "a", 10: "a", 20: "a", 30: "a", 40: "a", 45: "a", 50: "b", 60: None}
+    chains = network.merge_chains(graph, [keys[wid] for wid in graph.ids])
+    # 30 has two branches flowing into it so it starts a new chain, and 60
+    # can't be merged
+    assert [[graph.ids[idx] for idx in chain] for chain in chains] == [
+        [5, 10],
+        [30, 40, 45]
+    ]
+
+
+def test_write_segments_to_sqlite(tmp_path):
+    path = str(tmp_path / "water.mbtiles")
+    network.write_segments_to_sqlite([(5, 5), (10, 5)], path)
+    con = sqlite3.connect(path)
+    assert con.execute(
+        "SELECT merged_id FROM waterways_segments WHERE id = 10"
+    ).fetchone() == (5,)
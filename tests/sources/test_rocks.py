@@ -1,5 +1,6 @@
 # pylint: disable=missing-function-docstring
 """Tests for sources.util.rocks"""
+import csv
 from numbers import Number
 import pytest
 
@@ -114,3 +115,46 @@ def test_infer_metadata_from_csv_row_disallows_unknown_lithology():
     row = {"lithology": "totally not a valid lithology", "title": "foo"}
     with pytest.raises(ValueError):
         rocks.infer_metadata_from_csv_row(row)
+
+def write_units_csv(path, codes):
+    with open(path, "w", encoding="utf-8") as units_file:
+        writer = csv.DictWriter(units_file, fieldnames=["code", "title", "description"])
+        writer.writeheader()
+        for code in codes:
+            writer.writerow({"code": code, "title": "sandstone", "description": "some sandstone"})
+
+def read_codes(path):
+    with open(path, encoding="utf-8") as data_file:
+        return [row["code"] for row in csv.DictReader(data_file)]
+
+def test_infer_metadata_from_csv_writes_uncertain_rows_for_every_unit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_units_csv("units.csv", ["Ts", "Kjf"])
+    assert read_codes(rocks.infer_metadata_from_csv("units.csv")) == ["Ts", "Ts?", "Kjf", "Kjf?"]
+
+def test_infer_metadata_from_csv_only_writes_uncertain_rows_for_specified_codes(
+        tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_units_csv("units.csv", ["Ts", "Kjf"])
+    data_path = rocks.infer_metadata_from_csv("units.csv", codes={"Ts", "Kjf", "Kjf?"})
+    assert read_codes(data_path) == ["Ts", "Kjf", "Kjf?"]
+
+def test_fill_in_custom_metadata_from_met_writes_one_row_per_unit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_units_csv("units.csv", ["Ts", "Kjf"])
+    data_path = rocks.infer_metadata_from_csv("units.csv")
+    num_input_rows = len(read_codes(data_path))
+    met_row = {col: None for col in rocks.METADATA_COLUMN_NAMES}
+    met_row.update({"code": "Ts", "formation": "Some Formation", "title": "met title"})
+    monkeypatch.setattr(rocks, "metadata_from_usgs_met", lambda _path: [
+        rocks.METADATA_COLUMN_NAMES.copy(),
+        [met_row[col] for col in rocks.METADATA_COLUMN_NAMES]
+    ])
+    rocks.fill_in_custom_metadata_from_met("units.met", data_path)
+    assert len(read_codes(data_path)) == num_input_rows
+    with open(data_path, encoding="utf-8") as data_file:
+        rows = {row["code"]: row for row in csv.DictReader(data_file)}
+    # Fills gaps...
+    assert rows["Ts"]["formation"] == "Some Formation"
+    # ...but doesn't overwrite existing data
+    assert rows["Ts"]["title"] == "sandstone"
@@ -0,0 +1,54 @@
+# pylint: disable=missing-function-docstring
+"""Tests for sources.util.text"""
+from difflib import SequenceMatcher
+
+from sources.util import text
+
+
+def naive_remove_similar_pieces(pieces, threshold=0.80):
+    return [
+        piece for idx, piece in enumerate(pieces)
+        if not any(
+            SequenceMatcher(None, piece, candidate).ratio() > threshold
+            for candidate in pieces[:idx]
+        )
+    ]
+
+
+def test_remove_similar_pieces_keeps_the_first_of_similar_pieces():
+    pieces = [
+        "Massive sandstone with thin shale interbeds",
+        "Conglomerate",
+        "Massive sandstone with thin shale interbed",
+    ]
+    assert text.remove_similar_pieces(pieces) == pieces[0:2]
+
+
+def test_remove_similar_pieces_keeps_dissimilar_pieces():
+    pieces = ["Sandstone", "Shale", "Siltstone and mudstone"]
+    assert text.remove_similar_pieces(pieces) == pieces
+
+
+def test_remove_similar_pieces_matches_sequence_matcher():
+    pieces = [
+        "Marine sandstone and siltstone",
+        "Marine sandstone and siltstones",
+        "Nonmarine sandstone, siltstone",
+        "Sandstone",
+        "Sandstones",
+        "Diatomaceous shale",
+        "Diatomaceous mudstone",
+        "Marine siltstone and sandstone",
+        "Sand",
+    ]
+    assert text.remove_similar_pieces(pieces) == naive_remove_similar_pieces(pieces)
+    assert (
+        text.remove_similar_pieces(pieces, threshold=0.5)
+        == naive_remove_similar_pieces(pieces, threshold=0.5)
+    )
+
+
+def test_remove_similar_sentences():
+    assert text.remove_similar_sentences(
+        "Sandstone and shale. Conglomerate. Sandstone and shales"
+    ) == "Sandstone and shale. Conglomerate"
@@ -2,9 +2,33 @@
 """Tests for sources util"""
 
 import pathlib
+import xml.etree.ElementTree as ET
+
 from sources import util
 
 def test_extless_basename_removes_extension():
     path = str(pathlib.Path(__file__))
     assert path.endswith(".py")
     assert util.extless_basename(path) == "test_util"
+
+def test_merge_layers_converts_a_union_of_all_paths_at_once(tmp_path, monkeypatch):
+    calls = []
+    def fake_call_cmd(args, **_kwargs):
+        vrt_path = args[3]
+        with open(vrt_path, encoding="utf-8") as vrt_file:
+            calls.append((args, ET.fromstring(vrt_file.read())))
+    monkeypatch.setattr(util, "call_cmd", fake_call_cmd)
+    output_path = str(tmp_path / "merged.shp")
+    util.merge_layers(["a/polygons.shp", "b/polygons.shp"], output_path)
+    assert len(calls) == 1
+    args, vrt = calls[0]
+    assert args[0:3] == ["ogr2ogr", "-overwrite", output_path]
+    union_layer = vrt.find("OGRVRTUnionLayer")
+    assert union_layer.get("name") == "merged"
+    assert [layer.find("SrcLayer").text for layer in union_layer] == ["polygons", "polygons"]
+
+def test_vsi_path_points_inside_supported_archives():
+    assert util.vsi_path("/data/foo.zip", "foo/units.shp") == "/vsizip//data/foo.zip/foo/units.shp"
+    assert util.vsi_path("/data/foo.tar.gz", "units.shp") == "/vsitar//data/foo.tar.gz/units.shp"
+    assert util.vsi_path("/data/units.shp.gz") == "/vsigzip//data/units.shp.gz"
+    assert util.vsi_path("/data/foo.tar.Z", "units.shp") is None
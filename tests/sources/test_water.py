@@ -0,0 +1,68 @@
+# pylint: disable=missing-function-docstring
+"""Tests for sources.util.water"""
+import io
+
+from sources.util import water
+
+# Segments 1 and 2 flow into 3, which splits into 4 and 5
+VAA_CSV = """NHDPlusID,FromNode,ToNode
+1.0,10,30
+2.0,20,30
+3.0,30,40
+4.0,40,50
+5.0,40,
+"""
+
+
+def test_read_vaa_nodes():
+    ids, from_nodes, to_nodes = water.read_vaa_nodes(io.StringIO(VAA_CSV))
+    assert list(ids) == [1, 2, 3, 4, 5]
+    assert list(from_nodes) == [10, 20, 30, 40, 40]
+    assert list(to_nodes) == [30, 30, 40, 50, -1]
+
+
+def test_waterways_network_edges_matches_a_left_self_join():
+    edges = sorted(
+        water.waterways_network_edges(*water.read_vaa_nodes(io.StringIO(VAA_CSV))),
+        key=lambda edge: tuple(-1 if val is None else val for val in edge)
+    )
+    assert edges == [
+        (1, 3, None),
+        (2, 3, None),
+        (3, 4, 1),
+        (3, 4, 2),
+        (3, 5, 1),
+        (3, 5, 2),
+        (4, None, 3),
+        (5, None, 3)
+    ]
+
+
+def test_preferred_sources_ranks_nhd_over_others_over_tiger():
+    sources = ["tiger_water_06001", "nhdplus_h_1805", "omca_creeks"]
+    assert water.preferred_sources("nhdplus_h_1805", sources) == []
+    assert water.preferred_sources("omca_creeks", sources) == ["nhdplus_h_1805"]
+
+
+def test_preferred_sources_includes_every_better_source_in_a_chain():
+    # A TIGER waterbody covered only by an OMCA one is still a duplicate even
+    # if that OMCA waterbody is itself a duplicate of an NHD one
+    sources = ["nhdplus_h_1805", "omca_creeks", "tiger_water_06001"]
+    assert water.preferred_sources("tiger_water_06001", sources) == [
+        "nhdplus_h_1805",
+        "omca_creeks"
+    ]
+    assert water.preferred_sources("tiger_water_06001", sources + ["tiger_water_06013"]) == [
+        "nhdplus_h_1805",
+        "omca_creeks"
+    ]
+    assert water.preferred_sources("tiger_water_06013", sources + ["tiger_water_06013"]) == [
+        "nhdplus_h_1805",
+        "omca_creeks",
+        "tiger_water_06001"
+    ]
+
+
+def test_fcode_in_matches_nothing_without_fcodes():
+    assert water.fcode_in("FCode", {"46000": {}, "46006": {}}) == "FCode IN (46000, 46006)"
+    assert water.fcode_in("FCode", {}) == "0 = 1"
@@ -1,7 +1,9 @@
 """Methods for generating hydrologic data for Underfoot"""
 
 import argparse
+import hashlib
 import json
+import math
 import os
 import re
 import shutil
@@ -13,7 +15,16 @@ import psycopg2
 from database import DBNAME, SRID, make_database
 from sources import util
 from sources.util.citations import load_citation_for_source, CITATIONS_TABLE_NAME
-from sources.util.water import process_nhdplus_hr_source
+from sources.util.network import (
+    merge_chains,
+    network_from_rows,
+    reachable,
+    strahler_orders,
+    write_flow_paths_to_sqlite,
+    write_network_to_sqlite,
+    write_segments_to_sqlite
+)
+from sources.util.water import preferred_sources, process_nhdplus_hr_source
 from sources.util.tiger_water import process_tiger_water_for_fips
 
 
@@ -22,9 +33,100 @@ WATERWAYS_TABLE_NAME = "waterways"
 WATERWAYS_MASK_TABLE_NAME = "waterways_mask"
 WATERBODIES_TABLE_NAME = "waterbodies"
 WATERBODIES_MASK_TABLE_NAME = "waterbodies_mask"
+WATERWAYS_OVERVIEW_TABLE_NAME = "waterways_overview"
+WATERBODIES_OVERVIEW_TABLE_NAME = "waterbodies_overview"
+# Fraction of a waterbody that has to be covered by a waterbody from a
+# preferred source for it to be considered a duplicate
+WATERBODIES_DUPLICATE_OVERLAP = 0.8
+WATERBODIES_DUPLICATES_TABLE_NAME = "waterbodies_duplicates"
+# Overview layers are only shown at z7-8, where a tile unit is about 0.0003
+# degrees, so there's no point in keeping detail much finer than that
+OVERVIEW_SIMPLIFY_TOLERANCE = 0.0003
+# Minimum area in square degrees for a waterbody to be in the overview, and for
+# a hole in one to be kept
+OVERVIEW_MIN_AREA = 0.00001
+# Prefixes of sources for TIGER counties. All the counties in a pack can be
+# batched into one source so they get loaded as a single table
+TIGER_WATER_SOURCE_PREFIX = "tiger_water_"
+TIGER_WATER_BATCH_SOURCE_PREFIX = "tiger_water_batch_"
 WATERSHEDS_TABLE_NAME = "watersheds"
 WATERSHEDS_MASK_TABLE_NAME = "watersheds_mask"
+WATERSHEDS_MASK_PARTS_TABLE_NAME = "watersheds_mask_parts"
+WATERSHEDS_MASK_BUFFERED_PARTS_TABLE_NAME = "watersheds_mask_buffered_parts"
+# Zoom ranges for each hydrologic unit level of watersheds. Watersheds without
+# a level, i.e. not from the WBD, show up at every zoom
+WATERSHEDS_ZOOM_TIERS = [
+    (7, 8, "hu_level = 6 OR hu_level IS NULL"),
+    (9, 10, "hu_level = 8 OR hu_level IS NULL"),
+    (11, 14, "hu_level = 10 OR hu_level IS NULL")
+]
 WATERWAYS_NETWORK_TABLE_NAME = "waterways_network"
+WATERWAYS_FLOW_TABLE_NAME = "waterways_flow"
+WATERWAYS_STREAM_ORDERS_TABLE_NAME = "waterways_stream_orders"
+WATERWAYS_SEGMENTS_TABLE_NAME = "waterways_segments"
+WATERWAYS_TRIM_BOUNDARY_TABLE_NAME = "waterways_trim_boundary"
+WATERWAYS_TRIM_AREA_TABLE_NAME = "waterways_trim_area"
+WATERWAYS_DETAILED_TABLE_NAME = "waterways_detailed"
+# Hydrologic unit level of the watersheds that bound the detailed waterways
+# when trimming
+WATERWAYS_TRIM_HU_LEVEL = 10
+# Minimum Strahler order of the main stems kept outside the detailed area when
+# trimming
+WATERWAYS_TRIM_MIN_ORDER = 4
+# Consecutive waterways only get merged if all of these match
+WATERWAYS_MERGE_COLUMNS = [
+    "source",
+    "name",
+    "type",
+    "is_natural",
+    "is_imaginary",
+    "is_detailed",
+    "permanence",
+    "surface"
+]
+# Columns that go in the tiles, which should only be what's needed to style
+# features. Everything else goes in the _attrs tables and can be looked up by id
+WATERWAYS_TILE_COLUMNS = [
+    "id",
+    "type",
+    "is_natural",
+    "is_imaginary",
+    "permanence",
+    "surface",
+    "strahler_order"
+]
+WATERWAYS_ATTRS_COLUMNS = WATERWAYS_TILE_COLUMNS + [
+    "name",
+    "source",
+    "source_id",
+    "source_id_attr",
+    "length"
+]
+WATERBODIES_TILE_COLUMNS = ["id", "type", "is_natural", "permanence"]
+WATERBODIES_ATTRS_COLUMNS = WATERBODIES_TILE_COLUMNS + [
+    "name",
+    "source",
+    "source_id",
+    "source_id_attr",
+    "fips",
+    "area"
+]
+WATERSHEDS_TILE_COLUMNS = ["id", "hu_level"]
+WATERSHEDS_ATTRS_COLUMNS = WATERSHEDS_TILE_COLUMNS + [
+    "name",
+    "source",
+    "source_id",
+    "source_id_attr"
+]
+# Minimum zooms for waterways by Strahler order, so low zoom tiles only get the
+# bigger streams. Waterways that aren't part of a network have no order and
+# show up at the lowest zoom like they always have.
+WATERWAYS_ZOOM_TIERS = [
+    (9, "strahler_order IS NULL OR strahler_order >= 4"),
+    (10, "strahler_order = 3"),
+    (11, "strahler_order = 2"),
+    (12, "strahler_order = 1")
+]
 
 
 def clean_sources(sources, debug=False):
@@ -37,8 +139,36 @@ def clean_sources(sources, debug=False):
         shutil.rmtree(work_path)
 
 
-def process_source(source, clean=False, cleandb=False, cleanfiles=False, debug=False):
-    """Process water source"""
+def batch_tiger_water_sources(sources):
+    """Replace all per-county TIGER sources with a single batched source
+
+    Returns the new list of sources and the FIPS codes of the counties in the
+    batch. The batch gets named after a hash of its counties so different
+    packs don't clobber each other's tables.
+    """
+    fips_codes = sorted(
+        source.replace(TIGER_WATER_SOURCE_PREFIX, "")
+        for source in sources
+        if source.startswith(TIGER_WATER_SOURCE_PREFIX)
+        and not source.startswith(TIGER_WATER_BATCH_SOURCE_PREFIX)
+    )
+    if len(fips_codes) < 2:
+        return sources, []
+    fips_hash = hashlib.md5(",".join(fips_codes).encode("utf-8")).hexdigest()[:8]
+    batch_source = f"{TIGER_WATER_BATCH_SOURCE_PREFIX}{fips_hash}"
+    batched_sources = [
+        source for source in sources
+        if not source.startswith(TIGER_WATER_SOURCE_PREFIX)
+    ]
+    return batched_sources + [batch_source], fips_codes
+
+
+def process_source(source, clean=False, cleandb=False, cleanfiles=False, debug=False,
+                   fips_codes=None):
+    """Process water source
+
+    Batched TIGER sources need the FIPS codes of the counties in the batch.
+    """
     if debug:
         util.log(f"water: processing source: {source}")
     path = os.path.join("sources", f"{source}.py")
@@ -58,8 +188,15 @@ def process_source(source, clean=False, cleandb=False, cleanfiles=False, debug=F
               f"{source.upper()}_GDB.zip",
           gdb_name=f"{source.upper()}_GDB.gdb"
         )
-    elif source.startswith("tiger_water_"):
-        fips_code = source.replace("tiger_water_", "")
+    elif source.startswith(TIGER_WATER_BATCH_SOURCE_PREFIX):
+        if not fips_codes:
+            raise ValueError(f"{source} is a batch of TIGER counties but has no FIPS codes")
+        process_tiger_water_for_fips(
+            fips_codes,
+            source=os.path.join(os.path.realpath(__file__), "sources", source)
+        )
+    elif source.startswith(TIGER_WATER_SOURCE_PREFIX):
+        fips_code = source.replace(TIGER_WATER_SOURCE_PREFIX, "")
         process_tiger_water_for_fips(
             [fips_code],
             source=os.path.join(os.path.realpath(__file__), "sources", source)
@@ -105,6 +242,19 @@ def process_source(source, clean=False, cleandb=False, cleanfiles=False, debug=F
                 SET geom = ST_MakeValid(geom)
                 WHERE NOT ST_IsValid(geom)
                 """)
+        if layer == "waterbodies":
+            # Only TIGER waterbodies come from a particular county
+            util.run_sql(f"""
+                ALTER TABLE {source_table_name}
+                ADD COLUMN IF NOT EXISTS fips VARCHAR(5)
+            """)
+        if layer == "watersheds":
+            # Only NHD watersheds come in multiple hydrologic unit levels
+            util.run_sql(f"""
+                ALTER TABLE {source_table_name}
+                ADD COLUMN IF NOT EXISTS hu_level INTEGER
+            """)
+    update_imaginary_source_waterways(source)
     network_path = os.path.join(work_path, "waterways-network.csv")
     if os.path.isfile(network_path):
         network_table_name = f"{source}_waterways_network"
@@ -119,30 +269,159 @@ def process_source(source, clean=False, cleandb=False, cleanfiles=False, debug=F
             """,
             dbname=DBNAME
         )
-        util.run_sql(f"DELETE FROM {network_table_name}")
-        util.call_cmd(f"""
-            psql {DBNAME} -c "\\copy {network_table_name} FROM '{network_path}' WITH CSV HEADER"
-        """, shell=True)
+        util.copy_csv_to_table(network_table_name, network_path, dbname=DBNAME)
+
+
+def update_imaginary_source_waterways(source):
+    """
+    Set the imaginary column in a source's waterways table for all ways that
+    are effectively imaginary, i.e. they depict the path water might take
+    through a waterbody. NHD lumps these in the "artificial" type, even though
+    the artificer in these cases are mapmapkers, not people making physical
+    changes on the ground. Only the source's own waterbodies are considered.
+    """
+    waterways_table_name = f"{source}_waterways"
+    waterbodies_table_name = f"{source}_waterbodies"
+    try:
+        util.run_sql(f"""
+            ALTER TABLE {waterways_table_name}
+            ADD COLUMN IF NOT EXISTS is_imaginary INTEGER DEFAULT 0
+        """)
+    except psycopg2.errors.UndefinedTable:
+        return
+    try:
+        util.run_sql(f"""
+            UPDATE {waterways_table_name} w
+            SET is_imaginary = CASE
+                WHEN EXISTS (
+                    SELECT 1
+                    FROM {waterbodies_table_name} b
+                    WHERE ST_Contains(b.geom, w.geom)
+                ) THEN 1
+                ELSE 0
+                END
+            WHERE w.type = 'artificial'
+        """)
+    except psycopg2.errors.UndefinedTable:
+        util.log(f"{waterbodies_table_name} doesn't exist, skipping imaginary waterways...")
 
 
 def process_sources(sources, clean=False, cleandb=False, cleanfiles=False, procs=NUM_PROCESSES,
-                    debug=False):
-    """Process multiple sources in parallel processes"""
+                    debug=False, tiger_fips_codes=None):
+    """Process multiple sources in parallel processes
+
+    tiger_fips_codes are the counties in a batched TIGER source, if there is one
+    """
     with Pool(processes=procs) as pool:
         pool.starmap(
             process_source,
-            [[src, clean, cleandb, cleanfiles] for src in sources])
+            [
+                [
+                    src,
+                    clean,
+                    cleandb,
+                    cleanfiles,
+                    debug,
+                    tiger_fips_codes if src.startswith(TIGER_WATER_BATCH_SOURCE_PREFIX) else None
+                ]
+                for src in sources
+            ])
+
+
+def create_source_partitions(table_name, sources):
+    """Create a partition of a table partitioned by source for each source"""
+    for source in sources:
+        util.run_sql(f"""
+            CREATE TABLE {table_name}_{source}
+            PARTITION OF {table_name}
+            FOR VALUES IN ('{source}')
+        """)
+
 
+def index_source_partitions(table_name, sources, index_column="geom", procs=NUM_PROCESSES):
+    """Build spatial indexes on each partition in parallel and then the parent
 
-def load_waterways(sources, debug=False):
-    """Load waterways into the database"""
+    Partition indexes that match the parent index get attached to it instead
+    of being rebuilt, so the parent index is cheap once they exist
+    """
+    with Pool(processes=procs) as pool:
+        pool.starmap(
+            util.run_sql,
+            [
+                [
+                    f"""
+                        CREATE INDEX {table_name}_{source}_{index_column}_idx
+                        ON {table_name}_{source} USING GIST({index_column})
+                    """
+                ]
+                for source in sources
+            ]
+        )
+    util.run_sql(f"""
+        CREATE INDEX {table_name}_{index_column}_idx ON {table_name} USING GIST({index_column})
+    """)
+
+
+def load_waterways_source(source):
+    """Load waterways from a single source into its partition"""
+    source_table_name = f"{source}_waterways"
+    sql = f"""
+        INSERT INTO {WATERWAYS_TABLE_NAME}_{source} (
+            name,
+            source,
+            source_id_attr,
+            source_id,
+            type,
+            is_natural,
+            is_imaginary,
+            permanence,
+            surface,
+            geom
+        )
+        SELECT
+            max(name),
+            '{source}',
+            max(source_id_attr),
+            source_id,
+            max(type),
+            max(is_natural),
+            max(is_imaginary),
+            max(permanence),
+            max(surface),
+            ST_Collect(ST_SimplifyPreserveTopology(geom, 0.00001)) AS geom
+        FROM {source_table_name}
+        GROUP BY source_id
+    """
+    overview_sql = f"""
+        UPDATE {WATERWAYS_TABLE_NAME}_{source}
+        SET
+            length = ST_Length(geom),
+            is_overview = (
+                name IS NOT NULL
+                AND is_natural = 1
+                AND permanence = 'perennial'
+            )::int
+    """
+    try:
+        util.run_sql(sql)
+        util.run_sql(overview_sql)
+    except psycopg2.errors.UndefinedTable:
+        util.log(f"{source_table_name} doesn't exist, skipping...")
+
+
+def load_waterways(sources, procs=NUM_PROCESSES, debug=False):
+    """Load waterways into the database
+
+    The waterways table is partitioned by source so each source can be loaded
+    in its own process.
+    """
     if debug:
         util.log(f"water: loading waterways for sources: {sources}")
     util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_TABLE_NAME}", dbname=DBNAME)
     util.run_sql(
         f"""
             CREATE TABLE {WATERWAYS_TABLE_NAME} (
-                id SERIAL PRIMARY KEY,
+                id SERIAL,
                 name TEXT,
                 source VARCHAR(32),
                 source_id VARCHAR(32),
@@ -152,18 +431,33 @@ def load_waterways(sources, debug=False):
                 is_imaginary INTEGER DEFAULT 0,
                 permanence VARCHAR(64) DEFAULT 'permanent',
                 surface VARCHAR(64) DEFAULT 'surface',
-                geom geometry(MultiLineString, {SRID})
-            )
+                strahler_order INTEGER,
+                length DOUBLE PRECISION,
+                is_overview INTEGER DEFAULT 0,
+                is_detailed INTEGER DEFAULT 1,
+                geom geometry(MultiLineString, {SRID}),
+                PRIMARY KEY (id, source)
+            ) PARTITION BY LIST (source)
         """,
         dbname=DBNAME
     )
+    create_source_partitions(WATERWAYS_TABLE_NAME, sources)
+    with Pool(processes=procs) as pool:
+        pool.map(load_waterways_source, sources)
+    index_source_partitions(WATERWAYS_TABLE_NAME, sources, procs=procs)
     util.run_sql(f"""
-        CREATE INDEX {WATERWAYS_TABLE_NAME}_geom_idx ON {WATERWAYS_TABLE_NAME} USING GIST(geom)
+        CREATE INDEX {WATERWAYS_TABLE_NAME}_is_overview_idx
+        ON {WATERWAYS_TABLE_NAME} (is_overview)
+        WHERE is_overview = 1
     """)
-    for source in sources:
-        source_table_name = f"{source}_waterways"
-        sql = f"""
-            INSERT INTO {WATERWAYS_TABLE_NAME} (
+
+
+def load_waterbodies_source(source):
+    """Load waterbodies from a single source into its partition"""
+    source_table_name = f"{source}_waterbodies"
+    try:
+        util.run_sql(f"""
+            INSERT INTO {WATERBODIES_TABLE_NAME}_{source} (
                 name,
                 source,
                 source_id_attr,
@@ -171,30 +465,35 @@ def load_waterways(sources, debug=False):
                 type,
                 is_natural,
                 permanence,
-                surface,
+                fips,
+                area,
+                is_overview,
                 geom
             )
             SELECT
-                max(name),
+                name,
                 '{source}',
-                max(source_id_attr),
+                source_id_attr,
                 source_id,
-                max(type),
-                max(is_natural),
-                max(permanence),
-                max(surface),
-                ST_Collect(ST_SimplifyPreserveTopology(geom, 0.00001)) AS geom
+                type,
+                is_natural::int,
+                permanence,
+                fips,
+                ST_Area(geom),
+                (name IS NOT NULL AND ST_Area(geom) > {OVERVIEW_MIN_AREA})::int,
+                geom
             FROM {source_table_name}
-            GROUP BY source_id
-        """
-        try:
-            util.run_sql(sql)
-        except psycopg2.errors.UndefinedTable:
-            util.log(f"{source_table_name} doesn't exist, skipping...")
+        """)
+    except psycopg2.errors.UndefinedTable:
+        util.log(f"{source_table_name} doesn't exist, skipping...")
+
 
+def load_waterbodies(sources, procs=NUM_PROCESSES, debug=False):
+    """Load waterbodies into the database
 
-def load_waterbodies(sources, debug=False):
-    """Load waterbodies into the database"""
+    Like waterways, waterbodies are partitioned by source and loaded in
+    parallel.
+    """
     if debug:
         util.log(f"water: loading waterbodies for sources: {sources}")
     util.run_sql(
@@ -202,7 +501,7 @@ def load_waterbodies(sources, debug=False):
     util.run_sql(
         f"""
             CREATE TABLE {WATERBODIES_TABLE_NAME} (
-                id SERIAL PRIMARY KEY,
+                id SERIAL,
                 name TEXT,
                 source VARCHAR(32),
                 source_id VARCHAR(32),
@@ -210,41 +509,135 @@ def load_waterbodies(sources, debug=False):
                 type VARCHAR(128),
                 is_natural INTEGER DEFAULT 1,
                 permanence VARCHAR(64) DEFAULT 'permanent',
-                geom geometry(MultiPolygon, {SRID})
-            )
+                fips VARCHAR(5),
+                area DOUBLE PRECISION,
+                is_overview INTEGER DEFAULT 0,
+                geom geometry(MultiPolygon, {SRID}),
+                PRIMARY KEY (id, source)
+            ) PARTITION BY LIST (source)
         """,
         dbname=DBNAME
     )
+    create_source_partitions(WATERBODIES_TABLE_NAME, sources)
+    with Pool(processes=procs) as pool:
+        pool.map(load_waterbodies_source, sources)
+    index_source_partitions(WATERBODIES_TABLE_NAME, sources, procs=procs)
     util.run_sql(f"""
-        CREATE INDEX {WATERBODIES_TABLE_NAME}_geom_idx ON {WATERBODIES_TABLE_NAME} USING GIST(geom)
+        CREATE INDEX {WATERBODIES_TABLE_NAME}_is_overview_idx
+        ON {WATERBODIES_TABLE_NAME} (is_overview)
+        WHERE is_overview = 1
     """)
-    for source in sources:
-        source_table_name = f"{source}_waterbodies"
-        util.run_sql(f"""
-            INSERT INTO {WATERBODIES_TABLE_NAME} (
-                name,
-                source,
-                source_id_attr,
-                source_id,
-                type,
-                is_natural,
-                permanence,
-                geom
-            )
+
+
+def find_waterbody_duplicates_source(source, sources):
+    """Record waterbodies from a source that duplicate ones from better sources
+
+    Sources are ranked by waterbody_source_rank, so only one of two
+    overlapping waterbodies ever counts as a duplicate
+    """
+    better_sources = preferred_sources(source, sources)
+    if not better_sources:
+        return
+    better_sources_sql = ",".join([f"'{s}'" for s in better_sources])
+    util.run_sql(f"""
+        INSERT INTO {WATERBODIES_DUPLICATES_TABLE_NAME} (id, source)
+        SELECT b.id, b.source
+        FROM {WATERBODIES_TABLE_NAME}_{source} b
+        WHERE EXISTS (
+            SELECT 1
+            FROM {WATERBODIES_TABLE_NAME} a
+            WHERE
+                a.source IN ({better_sources_sql})
+                AND a.geom && b.geom
+                AND ST_Intersects(a.geom, b.geom)
+                AND ST_Area(ST_Intersection(a.geom, b.geom))
+                    >= {WATERBODIES_DUPLICATE_OVERLAP} * b.area
+        )
+    """)
+
+
+def dedupe_waterbodies(sources, procs=NUM_PROCESSES, debug=False):
+    """Remove waterbodies that duplicate waterbodies from other sources
+
+    NHD and TIGER describe a lot of the same lakes and bays, so when a
+    waterbody is mostly covered by one from a preferred source, the preferred
+    one wins. Duplicates for each source are found in parallel against the
+    waterbodies as loaded and only deleted once they're all known, so the
+    result doesn't depend on which source gets checked first.
+    """
+    if debug:
+        util.log(f"water: deduplicating waterbodies for sources: {sources}")
+    if len(sources) < 2:
+        return
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERBODIES_DUPLICATES_TABLE_NAME}")
+    util.run_sql(f"""
+        CREATE TABLE {WATERBODIES_DUPLICATES_TABLE_NAME} (
+            id INTEGER,
+            source VARCHAR(32)
+        )
+    """)
+    with Pool(processes=procs) as pool:
+        pool.starmap(
+            find_waterbody_duplicates_source,
+            [[source, sources] for source in sources]
+        )
+    util.run_sql(f"""
+        DELETE FROM {WATERBODIES_TABLE_NAME} w
+        USING {WATERBODIES_DUPLICATES_TABLE_NAME} d
+        WHERE w.id = d.id AND w.source = d.source
+    """)
+    util.run_sql(f"DROP TABLE {WATERBODIES_DUPLICATES_TABLE_NAME}")
+
+
+def mask_watersheds_partition(staged_table_name, dump_table_name, min_id, max_id):
+    """Remove the masked area from a range of watersheds
+
+    Watersheds are diffed against the pieces of the mask they intersect, and
+    any resulting polygons that are entirely within a small buffer of the
+    existing mask are dropped, i.e. the slivers that might have resulted from
+    diffing a complex coastline.
+    """
+    util.run_sql(f"""
+        INSERT INTO {dump_table_name} (name, source_id_attr, source_id, hu_level, geom)
+        SELECT
+            name,
+            source_id_attr,
+            source_id,
+            hu_level,
+            geom
+        FROM (
             SELECT
-                name,
-                '{source}',
-                source_id_attr,
-                source_id,
-                type,
-                is_natural::int,
-                permanence,
-                geom
-            FROM {source_table_name}
-        """)
+                w.name,
+                w.source_id_attr,
+                w.source_id,
+                w.hu_level,
+                (ST_Dump(
+                    CASE
+                    WHEN mask.geom IS NULL THEN w.geom
+                    ELSE ST_Difference(w.geom, mask.geom)
+                    END
+                )).geom AS geom
+            FROM
+                {staged_table_name} w
+                    LEFT JOIN LATERAL (
+                        SELECT ST_Union(p.geom) AS geom
+                        FROM {WATERSHEDS_MASK_PARTS_TABLE_NAME} p
+                        WHERE ST_Intersects(p.geom, w.geom)
+                    ) mask ON TRUE
+            WHERE w.id BETWEEN {min_id} AND {max_id}
+        ) diffed
+        WHERE NOT COALESCE(
+            (
+                SELECT ST_Contains(ST_Union(b.geom), diffed.geom)
+                FROM {WATERSHEDS_MASK_BUFFERED_PARTS_TABLE_NAME} b
+                WHERE b.geom && diffed.geom
+            ),
+            FALSE
+        )
+    """)
 
 
-def load_watersheds(sources, debug=False):
+def load_watersheds(sources, procs=NUM_PROCESSES, debug=False):
     """Load watersheds into the database"""
     if debug:
         util.log(f"water: loading watersheds for sources: {sources}")
@@ -260,6 +653,7 @@ def load_watersheds(sources, debug=False):
                 source VARCHAR(32),
                 source_id VARCHAR(32),
                 source_id_attr VARCHAR(32),
+                hu_level INTEGER,
                 geom geometry(MULTIPOLYGON, {SRID})
             )
         """,
@@ -291,6 +685,7 @@ def load_watersheds(sources, debug=False):
                         source,
                         source_id_attr,
                         source_id,
+                        hu_level,
                         geom
                     )
                     SELECT
@@ -298,72 +693,115 @@ def load_watersheds(sources, debug=False):
                         '{source}',
                         source_id_attr,
                         source_id,
+                        hu_level,
                         geom
                     FROM {source_table_name}
                 """)
                 # Build the mask
                 util.initialize_masks_table(
                     WATERSHEDS_MASK_TABLE_NAME, source_table_name, buff=0.0001)
+                # Split the mask into small indexed pieces so each watershed
+                # only gets diffed against the bits of the mask it actually
+                # touches, and buffer those pieces once instead of buffering
+                # the whole mask for every row. Later sources just add their
+                # own pieces
+                util.subdivide_masks_table(
+                    WATERSHEDS_MASK_TABLE_NAME, WATERSHEDS_MASK_PARTS_TABLE_NAME)
+                util.subdivide_masks_table(
+                    WATERSHEDS_MASK_TABLE_NAME,
+                    WATERSHEDS_MASK_BUFFERED_PARTS_TABLE_NAME,
+                    buff=0.01
+                )
             except psycopg2.errors.UndefinedTable:
                 util.log(f"{source_table_name} doesn't exist, skipping...")
                 continue
         else:
             try:
-                source_dump_table_name = f"{source_table_name}_dump"
-                util.run_sql(f"DROP TABLE IF EXISTS {source_dump_table_name}")
-                util.run_sql(f"""
-                    CREATE TABLE {source_dump_table_name} AS
-                    SELECT
-                        name,
-                        source_id_attr,
-                        source_id,
-                        (ST_Dump(
-                            ST_Difference(
-                                geom,
-                                (SELECT geom FROM {WATERSHEDS_MASK_TABLE_NAME})
-                            )
-                        )).geom AS geom
-                    FROM
-                        {source_table_name}
-                """)
-                # Remove the polygons that are entirely within a small buffer of
-                # the existing mask, i.e. the slivers that might have resulted
-                # from diffing a complex coastline
-                util.run_sql(f"""
-                    DELETE FROM {source_dump_table_name}
-                    WHERE ST_Contains(
-                        (
-                            SELECT st_buffer(geom, 0.01)
-                            FROM {WATERSHEDS_MASK_TABLE_NAME}
-                        ),
-                        geom
-                    )
-                """)
-                # Insert the massaged polygons as multipolygons
-                util.run_sql(f"""
-                    INSERT INTO {WATERSHEDS_TABLE_NAME} (
-                        name,
-                        source,
-                        source_id_attr,
-                        source_id,
-                        geom
-                    )
-                    SELECT
-                        name,
-                        '{source}',
-                        source_id_attr,
-                        source_id,
-                        ST_Collect(geom)
-                    FROM {source_dump_table_name}
-                    GROUP BY name, source_id_attr, source_id
-                """)
-                util.run_sql(f"DROP TABLE {source_table_name}_dump")
-                # Update the mask
-                util.update_masks_table(
-                    WATERSHEDS_MASK_TABLE_NAME, source_table_name, buff=0.0001)
+                num_rows = util.run_sql(f"SELECT COUNT(*) FROM {source_table_name}")[0][0]
             except psycopg2.errors.UndefinedTable:
                 util.log(f"{source_table_name} doesn't exist, skipping...")
                 continue
+            source_dump_table_name = f"{source_table_name}_dump"
+            source_staged_table_name = f"{source_table_name}_staged"
+            # Number the watersheds in roughly spatial order so each partition
+            # covers a compact area
+            util.run_sql(f"DROP TABLE IF EXISTS {source_staged_table_name}")
+            util.run_sql(f"""
+                CREATE TABLE {source_staged_table_name} AS
+                SELECT
+                    row_number() OVER (
+                        ORDER BY ST_GeoHash(ST_Centroid(ST_Envelope(geom)))
+                    ) AS id,
+                    name,
+                    source_id_attr,
+                    source_id,
+                    hu_level,
+                    geom
+                FROM {source_table_name}
+            """)
+            # Every partition looks up its range of ids
+            util.run_sql(f"""
+                CREATE INDEX {source_staged_table_name}_id_idx
+                ON {source_staged_table_name} (id)
+            """)
+            util.run_sql(f"ANALYZE {source_staged_table_name}")
+            util.run_sql(f"DROP TABLE IF EXISTS {source_dump_table_name}")
+            util.run_sql(f"""
+                CREATE TABLE {source_dump_table_name} (
+                    name TEXT,
+                    source_id_attr VARCHAR(32),
+                    source_id VARCHAR(32),
+                    hu_level INTEGER,
+                    geom geometry
+                )
+            """)
+            partition_size = max(1, math.ceil(num_rows / procs))
+            partitions = [
+                [
+                    source_staged_table_name,
+                    source_dump_table_name,
+                    min_id,
+                    min_id + partition_size - 1
+                ]
+                for min_id in range(1, num_rows + 1, partition_size)
+            ]
+            with Pool(processes=procs) as pool:
+                pool.starmap(mask_watersheds_partition, partitions)
+            # Insert the massaged polygons as multipolygons
+            util.run_sql(f"""
+                INSERT INTO {WATERSHEDS_TABLE_NAME} (
+                    name,
+                    source,
+                    source_id_attr,
+                    source_id,
+                    hu_level,
+                    geom
+                )
+                SELECT
+                    name,
+                    '{source}',
+                    source_id_attr,
+                    source_id,
+                    hu_level,
+                    ST_Collect(geom)
+                FROM {source_dump_table_name}
+                GROUP BY name, source_id_attr, source_id, hu_level
+            """)
+            util.run_sql(f"DROP TABLE {source_dump_table_name}")
+            util.run_sql(f"DROP TABLE {source_staged_table_name}")
+            # Update the mask and its pieces
+            util.update_masks_table(
+                WATERSHEDS_MASK_TABLE_NAME, source_table_name, buff=0.0001)
+            util.append_masks_parts(
+                WATERSHEDS_MASK_PARTS_TABLE_NAME, source_table_name, mask_buff=0.0001)
+            util.append_masks_parts(
+                WATERSHEDS_MASK_BUFFERED_PARTS_TABLE_NAME,
+                source_table_name,
+                mask_buff=0.0001,
+                buff=0.01
+            )
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERSHEDS_MASK_PARTS_TABLE_NAME}")
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERSHEDS_MASK_BUFFERED_PARTS_TABLE_NAME}")
 
 
 def load_networks(sources, debug=False):
@@ -398,9 +836,300 @@ def load_networks(sources, debug=False):
                 """)
         except psycopg2.errors.UndefinedTable:
             util.log(f"{source_table_name} doesn't exist, skipping...")
+    return load_network_graph(debug=debug)
+
+
+def load_network_graph(debug=False):
+    """Build an in-memory graph of the waterways network keyed by waterway id
+
+    Source IDs are only unique within a source, so edges get resolved to
+    waterways.id by joining on both.
+    """
+    rows = util.run_sql(f"""
+        SELECT DISTINCT
+            w.id,
+            t.id,
+            n.to_source_id IS NOT NULL
+        FROM
+            {WATERWAYS_NETWORK_TABLE_NAME} n
+                LEFT JOIN {WATERWAYS_TABLE_NAME} w
+                    ON w.source = n.source AND w.source_id = n.source_id
+                LEFT JOIN {WATERWAYS_TABLE_NAME} t
+                    ON t.source = n.source AND t.source_id = n.to_source_id
+    """, quiet=not debug)
+    graph, num_dangling = network_from_rows(rows)
+    stats = graph.validate()
+    util.log(f"water: waterways network: {stats}, dangling references: {num_dangling}")
+    return graph
+
+
+def update_waterways_stream_orders(network):
+    """Store the Strahler order of each waterway in the network"""
+    orders = strahler_orders(network)
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_STREAM_ORDERS_TABLE_NAME}")
+    util.run_sql(f"""
+        CREATE TABLE {WATERWAYS_STREAM_ORDERS_TABLE_NAME} (
+            id INTEGER PRIMARY KEY,
+            strahler_order INTEGER
+        )
+    """)
+    util.copy_rows_to_table(
+        WATERWAYS_STREAM_ORDERS_TABLE_NAME,
+        ["id", "strahler_order"],
+        zip(network.ids, orders),
+        dbname=DBNAME
+    )
+    util.run_sql(f"""
+        UPDATE {WATERWAYS_TABLE_NAME} w SET strahler_order = o.strahler_order
+        FROM {WATERWAYS_STREAM_ORDERS_TABLE_NAME} o
+        WHERE w.id = o.id
+    """)
+    util.run_sql(f"DROP TABLE {WATERWAYS_STREAM_ORDERS_TABLE_NAME}")
+
+
+def load_trim_boundary(bbox=None, geojson_path=None):
+    """Load the area of interest into its own table
+
+    Waterways get trimmed to it, and attributes only get exported for
+    waterbodies and watersheds that intersect it
+    """
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_TRIM_BOUNDARY_TABLE_NAME}")
+    if geojson_path:
+        util.call_cmd([
+            "ogr2ogr",
+            "-f", "PostgreSQL",
+            f"PG:dbname={DBNAME}",
+            geojson_path,
+            "-nln", WATERWAYS_TRIM_BOUNDARY_TABLE_NAME,
+            "-nlt", "PROMOTE_TO_MULTI",
+            "-lco", "GEOMETRY_NAME=geom",
+            "-t_srs", f"EPSG:{SRID}"
+        ], check=True)
+        return
+    util.run_sql(f"""
+        CREATE TABLE {WATERWAYS_TRIM_BOUNDARY_TABLE_NAME} AS
+        SELECT ST_MakeEnvelope(
+            {bbox["left"]}, {bbox["bottom"]}, {bbox["right"]}, {bbox["top"]}, {SRID}
+        ) AS geom
+    """)
+
+
+def trim_waterways(network, bbox=None, geojson_path=None, debug=False):
+    """Generalize waterways that are far from the area of interest
+
+    Waterways intersecting the area keep full detail, as does anything up or
+    downstream of them within the intersecting HU10 watersheds. Everything
+    else gets marked as not detailed, and only the simplified main stems of
+    those get exported.
+    """
+    if not bbox and not geojson_path:
+        return
+    if debug:
+        util.log("water: trimming waterways")
+    load_trim_boundary(bbox=bbox, geojson_path=geojson_path)
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_TRIM_AREA_TABLE_NAME}")
+    util.run_sql(f"""
+        CREATE TABLE {WATERWAYS_TRIM_AREA_TABLE_NAME} AS
+        SELECT ST_Union(s.geom) AS geom
+        FROM
+            {WATERSHEDS_TABLE_NAME} s
+                JOIN {WATERWAYS_TRIM_BOUNDARY_TABLE_NAME} b ON ST_Intersects(s.geom, b.geom)
+        WHERE s.hu_level = {WATERWAYS_TRIM_HU_LEVEL}
+    """)
+    # Without any watersheds, stick to the area itself
+    util.run_sql(f"""
+        UPDATE {WATERWAYS_TRIM_AREA_TABLE_NAME}
+        SET geom = (SELECT ST_Union(geom) FROM {WATERWAYS_TRIM_BOUNDARY_TABLE_NAME})
+        WHERE geom IS NULL
+    """)
+    seed_ids = [row[0] for row in util.run_sql(f"""
+        SELECT w.id
+        FROM
+            {WATERWAYS_TABLE_NAME} w
+                JOIN {WATERWAYS_TRIM_BOUNDARY_TABLE_NAME} b ON ST_Intersects(w.geom, b.geom)
+    """, quiet=not debug)]
+    allowed_ids = [row[0] for row in util.run_sql(f"""
+        SELECT w.id
+        FROM
+            {WATERWAYS_TABLE_NAME} w
+                JOIN {WATERWAYS_TRIM_AREA_TABLE_NAME} a ON ST_Intersects(w.geom, a.geom)
+    """, quiet=not debug)]
+    detailed_ids = reachable(network, seed_ids, allowed_ids=allowed_ids)
+    if debug:
+        util.log(
+            f"water: {len(seed_ids)} waterways in the area, {len(detailed_ids)} "
+            "including connected waterways"
+        )
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_DETAILED_TABLE_NAME}")
+    util.run_sql(f"CREATE TABLE {WATERWAYS_DETAILED_TABLE_NAME} (id INTEGER PRIMARY KEY)")
+    util.copy_rows_to_table(
+        WATERWAYS_DETAILED_TABLE_NAME,
+        ["id"],
+        ((waterway_id,) for waterway_id in detailed_ids),
+        dbname=DBNAME
+    )
+    util.run_sql(f"""
+        UPDATE {WATERWAYS_TABLE_NAME} w
+        SET is_detailed = 0
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {WATERWAYS_DETAILED_TABLE_NAME} d WHERE d.id = w.id
+        )
+    """)
+    util.run_sql(f"""
+        UPDATE {WATERWAYS_TABLE_NAME}
+        SET geom = ST_Multi(ST_Simplify(geom, {OVERVIEW_SIMPLIFY_TOLERANCE}))
+        WHERE is_detailed = 0 AND strahler_order >= {WATERWAYS_TRIM_MIN_ORDER}
+    """)
+    for table_name in [
+        WATERWAYS_DETAILED_TABLE_NAME,
+        WATERWAYS_TRIM_AREA_TABLE_NAME,
+        WATERWAYS_TRIM_BOUNDARY_TABLE_NAME
+    ]:
+        util.run_sql(f"DROP TABLE {table_name}")
+
+
+def merge_waterways(network, debug=False):
+    """Merge chains of connected waterways with the same attributes
+
+    The merged waterway keeps the id of the segment farthest upstream, and
+    waterways_segments maps the ids of all the segments in the network that
+    got merged to it.
+    """
+    if debug:
+        util.log("water: merging waterways")
+    rows = util.run_sql(f"""
+        SELECT id, {", ".join(WATERWAYS_MERGE_COLUMNS)} FROM {WATERWAYS_TABLE_NAME}
+    """, quiet=not debug)
+    keys = [None] * len(network)
+    for row in rows:
+        idx = network.index(row[0])
+        if idx is not None:
+            keys[idx] = tuple(row[1:])
+    chains = merge_chains(network, keys)
+    util.log(
+        f"water: merging {sum(len(chain) for chain in chains)} waterways into "
+        f"{len(chains)}"
+    )
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_SEGMENTS_TABLE_NAME}")
+    util.run_sql(f"""
+        CREATE TABLE {WATERWAYS_SEGMENTS_TABLE_NAME} (
+            id INTEGER PRIMARY KEY,
+            merged_id INTEGER NOT NULL
+        )
+    """)
+    util.copy_rows_to_table(
+        WATERWAYS_SEGMENTS_TABLE_NAME,
+        ["id", "merged_id"],
+        (
+            (network.ids[idx], network.ids[chain[0]])
+            for chain in chains
+            for idx in chain
+        ),
+        dbname=DBNAME
+    )
+    util.run_sql(f"""
+        CREATE INDEX {WATERWAYS_SEGMENTS_TABLE_NAME}_merged_id_idx
+        ON {WATERWAYS_SEGMENTS_TABLE_NAME} (merged_id)
+    """)
+    util.run_sql(f"""
+        UPDATE {WATERWAYS_TABLE_NAME} w
+        SET geom = merged.geom, length = ST_Length(merged.geom)
+        FROM (
+            SELECT
+                s.merged_id,
+                ST_Multi(ST_LineMerge(ST_Collect(parts.geom))) AS geom
+            FROM
+                {WATERWAYS_SEGMENTS_TABLE_NAME} s
+                    JOIN LATERAL (
+                        SELECT (ST_Dump(segment.geom)).geom
+                        FROM {WATERWAYS_TABLE_NAME} segment
+                        WHERE segment.id = s.id
+                    ) parts ON TRUE
+            GROUP BY s.merged_id
+        ) merged
+        WHERE w.id = merged.merged_id
+    """)
+    util.run_sql(f"""
+        DELETE FROM {WATERWAYS_TABLE_NAME} w
+        USING {WATERWAYS_SEGMENTS_TABLE_NAME} s
+        WHERE w.id = s.id AND s.id != s.merged_id
+    """)
+
+
+def make_overviews(debug=False):
+    """Make generalized copies of the waterways and waterbodies for low zooms
+
+    Waterbodies lose holes smaller than OVERVIEW_MIN_AREA, e.g. little islands,
+    and everything gets simplified to about the resolution of a z8 tile.
+    """
+    if debug:
+        util.log("water: making overviews")
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_OVERVIEW_TABLE_NAME}")
+    util.run_sql(f"""
+        CREATE TABLE {WATERWAYS_OVERVIEW_TABLE_NAME} AS
+        SELECT
+            id,
+            name,
+            source,
+            source_id,
+            source_id_attr,
+            type,
+            is_natural,
+            is_imaginary,
+            permanence,
+            surface,
+            strahler_order,
+            length,
+            ST_Multi(
+                ST_SimplifyPreserveTopology(geom, {OVERVIEW_SIMPLIFY_TOLERANCE})
+            )::geometry(MultiLineString, {SRID}) AS geom
+        FROM {WATERWAYS_TABLE_NAME}
+        WHERE is_overview = 1
+    """)
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERBODIES_OVERVIEW_TABLE_NAME}")
+    util.run_sql(f"""
+        CREATE TABLE {WATERBODIES_OVERVIEW_TABLE_NAME} AS
+        SELECT
+            w.id,
+            max(w.name) AS name,
+            max(w.source) AS source,
+            max(w.source_id) AS source_id,
+            max(w.source_id_attr) AS source_id_attr,
+            max(w.type) AS type,
+            max(w.is_natural) AS is_natural,
+            max(w.permanence) AS permanence,
+            max(w.area) AS area,
+            ST_Multi(
+                ST_Collect(
+                    ST_SimplifyPreserveTopology(
+                        ST_MakePolygon(
+                            ST_ExteriorRing(polygon.geom),
+                            ARRAY(
+                                SELECT ST_ExteriorRing(ring.geom)
+                                FROM ST_DumpRings(polygon.geom) ring
+                                WHERE
+                                    ring.path[1] > 0
+                                    AND ST_Area(ring.geom) > {OVERVIEW_MIN_AREA}
+                            )
+                        ),
+                        {OVERVIEW_SIMPLIFY_TOLERANCE}
+                    )
+                )
+            )::geometry(MultiPolygon, {SRID}) AS geom
+        FROM
+            {WATERBODIES_TABLE_NAME} w,
+            LATERAL ST_Dump(w.geom) polygon
+        WHERE w.is_overview = 1
+        GROUP BY w.id
+    """)
+    for table_name in [WATERWAYS_OVERVIEW_TABLE_NAME, WATERBODIES_OVERVIEW_TABLE_NAME]:
+        util.run_sql(f"""
+            CREATE INDEX {table_name}_geom_idx ON {table_name} USING GIST(geom)
+        """)
 
 
-def make_mbtiles(sources, path="./water.mbtiles", bbox=None, geojson_path=None, debug=False):
+def make_mbtiles(sources, path="./water.mbtiles", bbox=None, geojson_path=None, network=None,
+                 debug=False):
     """Export water into am MBTiles file"""
     if debug:
         util.log(f"water: making mbtiles for sources: {sources}")
@@ -413,104 +1142,96 @@ def make_mbtiles(sources, path="./water.mbtiles", bbox=None, geojson_path=None,
     )
     if os.path.exists(gpkg_path):
         os.remove(gpkg_path)
-    table_names = [
-        WATERWAYS_TABLE_NAME,
-        WATERBODIES_TABLE_NAME,
-        WATERSHEDS_TABLE_NAME
-    ]
-    for idx, table_name in enumerate(table_names):
+    # Waterways get a layer per zoom tier, all of which end up in the same
+    # tile layer. Don't clip the waterways, useful to see connectivity across
+    # the entire watershed, but leave out the minor ones trim_waterways marked
+    # as not detailed
+    waterways_tile_columns_sql = ", ".join(WATERWAYS_TILE_COLUMNS)
+    waterways_where = f"is_detailed = 1 OR strahler_order >= {WATERWAYS_TRIM_MIN_ORDER}"
+    waterways_tier_layer_names = []
+    for idx, (minzoom, where) in enumerate(WATERWAYS_ZOOM_TIERS):
+        layer_name = f"{WATERWAYS_TABLE_NAME}_z{minzoom}"
         cmd = ["ogr2ogr"]
         if idx > 0:
             cmd += ["-update"]
         cmd += [
             gpkg_path,
             f"PG:dbname={DBNAME}",
-            table_name,
+            "-sql", f"""
+                SELECT {waterways_tile_columns_sql}, geom FROM {WATERWAYS_TABLE_NAME}
+                WHERE ({where}) AND ({waterways_where})
+            """,
+            "-nln", layer_name,
             "-a_srs", f"EPSG:{SRID}",
         ]
-        # Don't clip the waterways, useful to see connectivity across the
-        # entire watershed
-        if table_name != WATERWAYS_TABLE_NAME:
-            if geojson_path:
-                cmd += ["-clipdst", geojson_path]
-            elif bbox:
-                cmd += [
-                    "-clipdst",
-                    str(bbox["left"]),
-                    str(bbox["bottom"]),
-                    str(bbox["right"]),
-                    str(bbox["top"])
-                ]
         util.call_cmd(cmd, check=True)
-    # 1. Write additional overview layers of perennial ways and large bodies
-    waterways_overview_table_name = f"{WATERWAYS_TABLE_NAME}_overview"
-    waterbodies_overview_table_name = f"{WATERBODIES_TABLE_NAME}_overview"
-    cmd = [
-        "ogr2ogr",
-        "-update",
-        gpkg_path,
-        f"PG:dbname={DBNAME}",
-        "-sql", f"""
-            SELECT * FROM {WATERWAYS_TABLE_NAME}
-            WHERE
-                name IS NOT NULL
-                AND is_natural = 1 AND permanence = 'perennial'
-        """,
-        "-nln", waterways_overview_table_name,
-        "-a_srs", f"EPSG:{SRID}"
+        waterways_tier_layer_names.append((layer_name, minzoom))
+    # Watersheds get a layer per hydrologic unit level, each shown at its own
+    # range of zooms
+    watersheds_tile_columns_sql = ", ".join(WATERSHEDS_TILE_COLUMNS)
+    watersheds_tier_layers = [
+        (
+            f"{WATERSHEDS_TABLE_NAME}_z{minzoom}",
+            minzoom,
+            maxzoom,
+            f"""
+                SELECT {watersheds_tile_columns_sql}, geom FROM {WATERSHEDS_TABLE_NAME}
+                WHERE {where}
+            """
+        )
+        for minzoom, maxzoom, where in WATERSHEDS_ZOOM_TIERS
     ]
-    if geojson_path:
-        cmd += ["-clipdst", geojson_path]
-    elif bbox:
-        cmd += [
-            "-clipdst",
-            str(bbox["left"]),
-            str(bbox["bottom"]),
-            str(bbox["right"]),
-            str(bbox["top"])
-        ]
-    util.call_cmd(cmd, check=True)
-    cmd = [
-        "ogr2ogr",
-        "-update",
-        gpkg_path,
-        f"PG:dbname={DBNAME}",
-        "-sql", f"""
-            SELECT * FROM {WATERBODIES_TABLE_NAME}
-            WHERE name IS NOT NULL AND ST_Area(geom) > 0.00001
-        """,
-        "-nln", waterbodies_overview_table_name,
-        "-a_srs", f"EPSG:{SRID}"
+    # 1. Write additional overview layers of perennial ways and large bodies,
+    # which were already filtered and generalized when they were loaded
+    waterways_overview_table_name = WATERWAYS_OVERVIEW_TABLE_NAME
+    waterbodies_overview_table_name = WATERBODIES_OVERVIEW_TABLE_NAME
+    waterbodies_tile_columns_sql = ", ".join(WATERBODIES_TILE_COLUMNS)
+    layers = [
+        (
+            WATERBODIES_TABLE_NAME,
+            f"SELECT {waterbodies_tile_columns_sql}, geom FROM {WATERBODIES_TABLE_NAME}"
+        )
+    ] + [
+        (layer_name, sql) for layer_name, _minzoom, _maxzoom, sql in watersheds_tier_layers
+    ] + [
+        (
+            waterways_overview_table_name,
+            f"SELECT {waterways_tile_columns_sql}, geom FROM {waterways_overview_table_name}"
+        ),
+        (
+            waterbodies_overview_table_name,
+            f"SELECT {waterbodies_tile_columns_sql}, geom FROM {waterbodies_overview_table_name}"
+        )
     ]
-    if geojson_path:
-        cmd += ["-clipdst", geojson_path]
-    elif bbox:
-        cmd += [
-            "-clipdst",
-            str(bbox["left"]),
-            str(bbox["bottom"]),
-            str(bbox["right"]),
-            str(bbox["top"])
+    for layer_name, sql in layers:
+        cmd = [
+            "ogr2ogr",
+            "-update",
+            gpkg_path,
+            f"PG:dbname={DBNAME}",
+            "-sql", sql,
+            "-nln", layer_name,
+            "-a_srs", f"EPSG:{SRID}"
         ]
-    util.call_cmd(cmd, check=True)
+        if geojson_path:
+            cmd += ["-clipdst", geojson_path]
+        elif bbox:
+            cmd += [
+                "-clipdst",
+                str(bbox["left"]),
+                str(bbox["bottom"]),
+                str(bbox["right"]),
+                str(bbox["top"])
+            ]
+        util.call_cmd(cmd, check=True)
     # 1. Use `-dsco CONF` to write all these layers to the mbtiles in one fell
     # swoop
     conf = {
-        WATERWAYS_TABLE_NAME: {
-            "target_name": WATERWAYS_TABLE_NAME,
-            "minzoom": 9,
-            "maxzoom": 14
-        },
         WATERBODIES_TABLE_NAME: {
             "target_name": WATERBODIES_TABLE_NAME,
             "minzoom": 9,
             "maxzoom": 14
         },
-        WATERSHEDS_TABLE_NAME: {
-            "target_name": WATERSHEDS_TABLE_NAME,
-            "minzoom": 7,
-            "maxzoom": 14
-        },
         waterways_overview_table_name: {
             "target_name": waterways_overview_table_name,
             "minzoom": 7,
@@ -522,6 +1243,18 @@ def make_mbtiles(sources, path="./water.mbtiles", bbox=None, geojson_path=None,
             "maxzoom": 8
         }
     }
+    for layer_name, minzoom, maxzoom, _sql in watersheds_tier_layers:
+        conf[layer_name] = {
+            "target_name": WATERSHEDS_TABLE_NAME,
+            "minzoom": minzoom,
+            "maxzoom": maxzoom
+        }
+    for layer_name, minzoom in waterways_tier_layer_names:
+        conf[layer_name] = {
+            "target_name": WATERWAYS_TABLE_NAME,
+            "minzoom": minzoom,
+            "maxzoom": 14
+        }
     cmd = f"""
       ogr2ogr {path} {gpkg_path}
         -dsco MAX_SIZE=5000000
@@ -530,12 +1263,44 @@ def make_mbtiles(sources, path="./water.mbtiles", bbox=None, geojson_path=None,
         -dsco CONF='{json.dumps(conf)}'
     """
     util.call_cmd(re.sub(r'\s+', " ", cmd).strip(), shell=True)
-    util.add_table_from_query_to_mbtiles(
-        table_name=WATERWAYS_NETWORK_TABLE_NAME,
-        dbname=DBNAME,
-        query=f"SELECT * FROM {WATERWAYS_NETWORK_TABLE_NAME}",
-        mbtiles_path=path,
-        index_columns=["source_id", "to_source_id", "from_source_id"])
+    # 1. Add the rest of the attributes in tables keyed by id. Ways need the
+    # ones in the tiers and the overview, bodies and sheds only the ones that
+    # could have made it into the clipped tiles, i.e. the ones intersecting
+    # the same geojson_path or bbox they were clipped to
+    clipped_where = "TRUE"
+    if geojson_path or bbox:
+        load_trim_boundary(bbox=bbox, geojson_path=geojson_path)
+        clipped_where = f"""EXISTS (
+            SELECT 1 FROM {WATERWAYS_TRIM_BOUNDARY_TABLE_NAME} b
+            WHERE ST_Intersects(t.geom, b.geom)
+        )"""
+    for table_name, columns, where in [
+        (WATERWAYS_TABLE_NAME, WATERWAYS_ATTRS_COLUMNS, f"{waterways_where} OR is_overview = 1"),
+        (WATERBODIES_TABLE_NAME, WATERBODIES_ATTRS_COLUMNS, clipped_where),
+        (WATERSHEDS_TABLE_NAME, WATERSHEDS_ATTRS_COLUMNS, clipped_where)
+    ]:
+        util.add_table_from_query_to_mbtiles(
+            table_name=f"{table_name}_attrs",
+            dbname=DBNAME,
+            query=f"SELECT {', '.join(columns)} FROM {table_name} t WHERE {where}",
+            mbtiles_path=path,
+            index_columns=["id"])
+    util.run_sql(f"DROP TABLE IF EXISTS {WATERWAYS_TRIM_BOUNDARY_TABLE_NAME}")
+    if network is None:
+        network = load_network_graph(debug=debug)
+    write_network_to_sqlite(network, path, table_name=WATERWAYS_NETWORK_TABLE_NAME)
+    write_flow_paths_to_sqlite(network, path, table_name=WATERWAYS_FLOW_TABLE_NAME)
+    try:
+        write_segments_to_sqlite(
+            util.run_sql(
+                f"SELECT id, merged_id FROM {WATERWAYS_SEGMENTS_TABLE_NAME}",
+                quiet=not debug
+            ),
+            path,
+            table_name=WATERWAYS_SEGMENTS_TABLE_NAME
+        )
+    except psycopg2.errors.UndefinedTable:
+        util.log(f"{WATERWAYS_SEGMENTS_TABLE_NAME} doesn't exist, skipping...")
     sources_sql = ",".join([f"'{s}'" for s in sources])
     util.add_table_from_query_to_mbtiles(
         table_name=CITATIONS_TABLE_NAME,
@@ -548,38 +1313,51 @@ def make_mbtiles(sources, path="./water.mbtiles", bbox=None, geojson_path=None,
         index_columns=["source"])
     return path
 
-def update_imaginary_waterways():
-    """
-    Set the imaginary column in the waterways table for all ways that are
-    effectively imaginary, i.e. they depict the path water might take through
-    a waterbody. NHD lumps these in the "artificial" type, even though the
-    artificer in these cases are mapmapkers, not people making physical
-    changes on the ground.
-    """
-    util.run_sql(f"""
-        UPDATE {WATERWAYS_TABLE_NAME} SET is_imaginary = 1
-        FROM {WATERBODIES_TABLE_NAME}
-        WHERE
-            ST_CONTAINS({WATERBODIES_TABLE_NAME}.geom, {WATERWAYS_TABLE_NAME}.geom)
-            AND {WATERWAYS_TABLE_NAME}.type = 'artificial'
-    """)
-
 def make_water(
         sources, clean=False, cleandb=False, cleanfiles=False, bbox=None,
-        path="./water.mbtiles", procs=NUM_PROCESSES, debug=False, geojson_path=None):
-    """Process and load all water sources and write them to a MBTiles file"""
+        path="./water.mbtiles", procs=NUM_PROCESSES, debug=False, geojson_path=None,
+        batch_tiger=True, trim=False):
+    """Process and load all water sources and write them to a MBTiles file
+
+    With batch_tiger, all TIGER counties get processed and loaded as a single
+    source. Either way TIGER waterbodies keep their county FIPS code in the
+    fips attribute in waterbodies_attrs. With trim, only the main stems of
+    waterways far from the bbox or geojson_path get exported.
+    """
+    tiger_fips_codes = []
+    if batch_tiger:
+        sources, tiger_fips_codes = batch_tiger_water_sources(sources)
     if debug:
         util.log("water: making database")
     make_database()
     if clean:
         clean_sources(sources, debug=debug)
-    process_sources(sources, cleandb=cleandb, cleanfiles=cleanfiles, procs=procs, debug=debug)
-    load_waterways(sources, debug=debug)
-    load_waterbodies(sources, debug=debug)
-    update_imaginary_waterways()
-    load_watersheds(sources, debug=debug)
-    load_networks(sources, debug=debug)
-    return make_mbtiles(sources, path=path, bbox=bbox, geojson_path=geojson_path, debug=debug)
+    process_sources(
+        sources,
+        cleandb=cleandb,
+        cleanfiles=cleanfiles,
+        procs=procs,
+        debug=debug,
+        tiger_fips_codes=tiger_fips_codes
+    )
+    load_waterways(sources, procs=procs, debug=debug)
+    load_waterbodies(sources, procs=procs, debug=debug)
+    dedupe_waterbodies(sources, procs=procs, debug=debug)
+    load_watersheds(sources, procs=procs, debug=debug)
+    network = load_networks(sources, debug=debug)
+    update_waterways_stream_orders(network)
+    if trim:
+        trim_waterways(network, bbox=bbox, geojson_path=geojson_path, debug=debug)
+    merge_waterways(network, debug=debug)
+    make_overviews(debug=debug)
+    return make_mbtiles(
+        sources,
+        path=path,
+        bbox=bbox,
+        geojson_path=geojson_path,
+        network=network,
+        debug=debug
+    )
 
 
 if __name__ == "__main__":
@@ -605,6 +1383,24 @@ if __name__ == "__main__":
         action="store_true",
         help="Just clean the files extracted from the download"
     )
+    parser.add_argument(
+        "--geojson",
+        type=str,
+        help="Path to a GeoJSON file of the area to clip waterbodies and watersheds to"
+    )
+    parser.add_argument(
+        "--trim",
+        action="store_true",
+        help="""
+            Only export generalized main stems of waterways that aren't
+            connected to waterways in the area specified by --geojson
+        """
+    )
+    parser.add_argument(
+        "--no-batch-tiger",
+        action="store_true",
+        help="Process each TIGER county as its own source instead of as one batch"
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -616,4 +1412,7 @@ if __name__ == "__main__":
         clean=args.clean,
         cleandb=args.cleandb,
         cleanfiles=args.cleanfiles,
+        geojson_path=args.geojson,
+        trim=args.trim,
+        batch_tiger=not args.no_batch_tiger,
         debug=args.debug)